@@ -1,5 +1,7 @@
-from sqlalchemy import exc
-from .models import TestRuns, TestStates, db, startup
+import sqlite3
+from sqlalchemy import exc, func
+from .models import TestRuns, TestStates, Harvests, ResultsInfo, ResultsRollup, ResultsHistograms, \
+    RESULTS, db, startup
 
 
 def get_all_states():
@@ -59,7 +61,92 @@ def update_test_run_by_title(title, values):
 
 
 def remove_test_run(trid):
+    clear_results(trid)
     test_run = TestRuns.query.get(trid)
     db.session.delete(test_run)
     db.session.commit()
     return test_run.title
+
+
+def clear_results(trid, slave=None):
+    """Remove results of a test run harvested from all slaves or from one slave."""
+    for model in list(RESULTS.values()) + [Harvests]:
+        query = model.query.filter_by(testrun_id=trid)
+        if slave is not None:
+            query = query.filter_by(slave=slave)
+        query.delete(synchronize_session=False)
+    db.session.commit()
+
+
+def save_results(trid, slave, table, columns):
+    """Insert rows harvested from a slave table, columns is a dictionary of arrays of values.
+    :return: the number of rows inserted.
+    """
+    model = RESULTS[table]
+    names = [name for name in columns if name in model.__table__.columns]
+    rows = [dict(zip(names, values), testrun_id=trid, slave=slave)
+            for values in zip(*[columns[name] for name in names])]
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+    return len(rows)
+
+
+def save_harvest(trid, slave, rows, error):
+    db.session.add(Harvests(trid, slave, rows, error))
+    db.session.commit()
+
+
+def get_harvests(trid):
+    return Harvests.query.filter_by(testrun_id=trid).order_by(Harvests.slave).all()
+
+
+def harvested_slaves(title):
+    """Slaves of a test run if its results have been harvested from all of them, otherwise []."""
+    test_run = get_test_run_by_title(title)
+    harvests = get_harvests(test_run.id) if test_run else []
+    if not harvests or any(harvest.error for harvest in harvests):
+        return []
+    return [harvest.slave for harvest in harvests]
+
+
+def results_conn(trid, slave):
+    """A connection to the master database where results of a test run harvested from a slave
+    look like the test run database on the slave: a temporary view per table.
+    """
+    db_conn = sqlite3.connect(db.engine.url.database)
+    for table, model in RESULTS.items():
+        db_conn.execute("CREATE TEMP VIEW %s AS SELECT * FROM %s WHERE testrun_id = %d "
+                        "AND slave = '%s'" % (table, model.__tablename__, trid,
+                                              slave.replace("'", "''")))
+    return db_conn
+
+
+def get_results_started(trid):
+    """The moment a harvested test run has started at, the same on all slaves."""
+    return db.session.query(func.min(ResultsInfo.timestamp_started)).filter_by(
+        testrun_id=trid).scalar()
+
+
+def get_results_counts(trid, action):
+    """Transactions of an action per second and response code, summed up between slaves."""
+    query = db.session.query(ResultsRollup.second, ResultsRollup.code, func.sum(ResultsRollup.count))
+    query = query.filter_by(testrun_id=trid, action=action, atomic=False)
+    return query.group_by(ResultsRollup.second, ResultsRollup.code).all()
+
+
+def get_results_bounds(trid, action):
+    """The exact minimum and maximum latency of completed transactions of an action per second."""
+    query = db.session.query(ResultsRollup.second, func.min(ResultsRollup.latency_min),
+                             func.max(ResultsRollup.latency_max))
+    query = query.filter_by(testrun_id=trid, action=action, atomic=False)
+    query = query.filter(ResultsRollup.code.isnot(None))
+    return query.group_by(ResultsRollup.second).all()
+
+
+def get_results_histograms(trid, action):
+    """Latency histograms of transactions of an action per second, merged between slaves."""
+    query = db.session.query(ResultsHistograms.second, ResultsHistograms.bucket,
+                             func.sum(ResultsHistograms.count))
+    query = query.filter_by(testrun_id=trid, action=action, atomic=False)
+    return query.group_by(ResultsHistograms.second, ResultsHistograms.bucket).all()
@@ -2,70 +2,85 @@ import asyncio
 from aiohttp import ServerDisconnectedError, ClientOSError
 from abc import ABCMeta, abstractmethod
 import tools
-# TODO: refactor the code of Action.atomic_*() methods
+import feeder
+
+
+BODY_CHUNK = 65536  # bytes of a response body read at once
 
 
 class Action(object):
-    """An abstract class all custom actions should inherit from."""
+    """An abstract class all custom actions should inherit from.
+    Set body_mode in a custom action to 'discard' or 'head' (first body_size bytes)
+    when response bodies are not needed in full, it can be set per request as well.
+    """
     __metaclass__ = ABCMeta
+    body_mode = 'full'
+    body_size = 1024
 
-    def __init__(self, conn, session, user, action):
-        self.conn = conn
+    def __init__(self, recorder, session, user, action):
+        self.recorder = recorder
         self.session = session
         self.user = user
         self.action = action
+        self.position = None  # position of the user in users.txt, set by the engine
+        self.intended = None  # when the current iteration has been planned to start, set by the engine
+        self.wait = 0.0       # how long the current iteration has waited for the concurrency cap
+        self.error = None     # an exception raised by the current iteration, see AsyncLoad.act()
 
     @abstractmethod
     async def act(self):
         """A method to imitate a single action by a single user."""
         pass
 
-    async def atomic_get(self, url, headers=None):
+    def feed(self, file_name, policy='sequential'):
+        """Return a record of test data from a CSV (with a header) or JSON-lines file
+        in the engine folder: a dictionary {column: value} for CSV, a parsed line for JSON lines.
+        Policy is 'sequential', 'random' or 'unique' (a record per user), see feeder.Feeder.
+        """
+        return feeder.get_feeder(file_name).next(policy, self.position)
+
+    async def atomic_get(self, url, headers=None, body_mode=None):
         """Async method sends an HTTP GET request and awaits for response.
-        On start, an entry is inserted into the database; on end - the entry is updated.
+        On end, a record about the request is passed to the recorder to be written in bulk.
 
         :return: a 3-tuple (response code, response reason, response body).
         """
-        with tools.LogSQL(self.conn, self.action, self.user) as sql:
-            sql.code = -1
-            sql.reason = 'Exception occurred but not caught (TODO).'
-            body = ''
-            try:
-                async with self.session.get(url, headers=headers) as response:
-                    await response.read()
-                    sql.code = response.status
-                    sql.reason = response.reason
-                    body = response.read()
-            except asyncio.CancelledError:
-                sql.code = tools.CODES['CancelledError']
-                sql.reason = 'Task cancelled by scheduler, exception suppressed'
-            except ServerDisconnectedError:
-                sql.code = tools.CODES['ServerDisconnectedError']
-                sql.reason = 'ServerDisconnectedError, exception suppressed'
-            except ClientOSError:
-                sql.code = tools.CODES['ClientOSError']
-                sql.reason = 'ClientOSError, exception suppressed'
-            return sql.code, sql.reason, body
+        return await self.atomic_request('GET', url, headers=headers, body_mode=body_mode)
 
-    async def atomic_post(self, url, headers=None, data=None):
+    async def atomic_post(self, url, headers=None, data=None, body_mode=None):
         """Async method sends an HTTP POST request and awaits for response.
-        On start, an entry is inserted into the database; on end - the entry is updated.
+        On end, a record about the request is passed to the recorder to be written in bulk.
 
         :return: a 3-tuple (response code, response reason, response body).
         """
-        with tools.LogSQL(self.conn, self.action, self.user) as sql:
+        return await self.atomic_request('POST', url, headers=headers, data=data,
+                                         body_mode=body_mode)
+
+    async def atomic_request(self, method, url, headers=None, data=None, body_mode=None):
+        """Send an HTTP request, stream the response body according to the body mode
+        and record the request together with bytes received and sent (headers and body).
+        """
+        with tools.LogSQL(self.recorder, self.action, self.user, intended=self.intended) as sql:
+            self.intended = None  # next requests of the iteration are planned once this one ends
             sql.code = -1
             sql.reason = 'Exception occurred but not caught (TODO).'
-            body = ''
+            body = b''
             try:
-                async with self.session.post(url, data=data, headers=headers) as response:
-                    await response.read()
+                async with self.session.request(method, url, data=data, headers=headers,
+                                                trace_request_ctx=sql) as response:
+                    body, size = await self.read_body(response, body_mode or self.body_mode)
                     sql.code = response.status
                     sql.reason = response.reason
-                    body = response.read()
-            except asyncio.CancelledError:
-                    sql.code = tools.CODES['CancelledError']
-                    sql.reason = 'Task cancelled by scheduler, exception suppressed'
+                    sql.bytes_in = size + sum([len(key) + len(value) + 4
+                                               for key, value in response.raw_headers])
+                    sql.bytes_out = len(str(response.request_info.real_url)) + \
+                        sum([len(key) + len(value) + 4
+                             for key, value in response.request_info.headers.items()]) + \
+                        int(response.request_info.headers.get('Content-Length') or 0)
+            except asyncio.CancelledError:  # recorded on exit, the rest of the iteration is cancelled
+                sql.code = tools.CODES['CancelledError']
+                sql.reason = 'Task cancelled by scheduler'
+                raise
             except ServerDisconnectedError:
                 sql.code = tools.CODES['ServerDisconnectedError']
                 sql.reason = 'ServerDisconnectedError, exception suppressed'
@@ -73,3 +88,21 @@ class Action(object):
                 sql.code = tools.CODES['ClientOSError']
                 sql.reason = 'ClientOSError, exception suppressed'
             return sql.code, sql.reason, body
+
+    async def read_body(self, response, body_mode):
+        """Read the response body chunk by chunk, so that memory does not grow with the body:
+        'discard' - nothing is kept, 'head' - first body_size bytes are kept, 'full' - all.
+        The body is always read to the end to let the connection be reused.
+
+        :return: a 2-tuple (kept part of the body, body size in bytes).
+        """
+        chunks = []
+        size = kept = 0
+        async for chunk in response.content.iter_chunked(BODY_CHUNK):
+            size += len(chunk)
+            if body_mode == 'full':
+                chunks.append(chunk)
+            elif body_mode == 'head' and kept < self.body_size:
+                chunks.append(chunk[:self.body_size - kept])
+                kept += len(chunks[-1])
+        return b''.join(chunks), size
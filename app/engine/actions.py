@@ -3,8 +3,12 @@
  * inherit from Action class, and the class name should start with 'Action';
  * act() methods should be decorated with @log_sql;
  * use atomic_get() and atomic_post() methods to send HTTP GET and HTTP POST requests.
+ * set body_mode = 'discard' (or 'head' to keep first body_size bytes) in an action class
+   if response bodies are not needed, to save memory; body_mode can be passed per request too.
  * append parameters to URLs if any, as usual: http://site/route?param1=value1&param2=value2.
  * to access user id inside act() methid, use self.user.
+ * to get test data (search terms, product ids, payloads) use self.feed('file.csv', policy),
+   put CSV (with a header) or JSON-lines (.jsonl) files next to this file, see feeder.py.
 """
 from action import Action
 from tools import log_sql
@@ -1,7 +1,11 @@
 import sys
+import time
+import random
 import asyncio
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector, TraceConfig
 import tools
+import feeder
+import planner
 import actions     # import is required, to let AsyncLoad.fetch() method work.
 try:
     import uvloop  # fails on Windows - RuntimeError: uvloop does not support Windows at the moment.
@@ -9,6 +13,11 @@ except ImportError:
     pass
 
 
+ARRIVAL_MAX_LAG = 1.0  # seconds an arrival of the open model may be late before it is dropped
+GRACEFUL_STOP = 5      # seconds for iterations in progress to complete once the test run is over
+CANCEL_WAIT = 1        # seconds for cancelled iterations to end once GRACEFUL_STOP is over
+
+
 def create_loop():
     """Function creates and returns an asyncio loop (on Windows) or uvloop (on Linux) instance.
     Slaves will use uvloop for test runs,
@@ -22,8 +31,14 @@ def create_loop():
     return loop
 
 
-def stop_loop(loop):
-    loop.stop()
+async def on_connection_queued_start(session, context, params):
+    context.queued = time.perf_counter()
+
+
+async def on_connection_queued_end(session, context, params):
+    """Add the time spent waiting for a pooled connection to the record of the request."""
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx.wait += time.perf_counter() - context.queued
 
 
 class AsyncLoad(object):
@@ -31,32 +46,106 @@ class AsyncLoad(object):
     def __init__(self, test_run_id, slave_load):
         self.test_run_id = test_run_id
         self.slave_load = slave_load
-        self.db_conn = tools.get_db_conn('%s.db' % self.test_run_id) if test_run_id else None
-        self.users = tools.load_users('users.txt')
+        self.recorder = tools.Recorder('%s.db' % self.test_run_id) if test_run_id else None
+        self.users = tools.UserIndex('users-%s.idx' % self.test_run_id) if test_run_id else None
+        self.client = slave_load.get('client', {}) if slave_load else {}
+        self.session = None
+        self.cap = None
+
+    async def open_session(self):
+        """Open the HTTP session according to the client profile of the test run.
+        Time a request waits for a pooled connection is traced, the rest is spent on the server.
+        """
+        if self.client.get('keepalive', 15):
+            keepalive = {'keepalive_timeout': self.client.get('keepalive', 15)}
+        else:
+            keepalive = {'force_close': True}
+        connector = TCPConnector(limit=self.client.get('limit', 100),
+                                 limit_per_host=self.client.get('limit_per_host', 0),
+                                 use_dns_cache=bool(self.client.get('dns_cache', 10)),
+                                 ttl_dns_cache=self.client.get('dns_cache', 10) or None,
+                                 **keepalive)
+        trace_config = TraceConfig()
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        self.session = ClientSession(connector=connector, trace_configs=[trace_config])
+        if self.client.get('concurrency'):
+            self.cap = asyncio.Semaphore(self.client['concurrency'])
+
+    async def close_session(self):
+        if self.session is not None:
+            await self.session.close()
 
-    async def fetch(self, session, user, action):
-        """Imitate activity of one user - keep doing a particular action in infinite loop,
-        until the task is stopped by the event loop according to the schedule.
+    def make_action(self, index, action):
+        """Create the action for the user at a position in users.txt.
         Note: keep 'import actions' to let this work.
         """
-        obj = getattr(sys.modules['actions'], action)(self.db_conn, session, user, action)
-        while True:
-            await obj.act()
+        obj = getattr(sys.modules['actions'], action)(self.recorder, self.session,
+                                                      self.users[index], action)
+        obj.position = index
+        return obj
+
+    async def fetch(self, index, action, intended, stopping):
+        """Imitate activity of one user - keep doing a particular action in a loop
+        until the user is stopped: the iteration in progress is completed, not cancelled.
+        The first iteration is planned by the pool, each next one - once the previous ends.
+        An iteration which has raised an exception is recorded as failed and the user goes on,
+        unless the user has no record of test data (feeder.FeederExhausted): then it stops.
+        """
+        obj = self.make_action(index, action)
+        await asyncio.sleep(intended - tools.get_timestamp())
+        while not stopping.is_set():
+            obj.intended = intended
+            await self.act(obj)
+            if isinstance(obj.error, feeder.FeederExhausted):
+                print('%s User %s stopped: %s' % (tools.log_timestamp_str(), obj.user,
+                                                  tools.error_reason(obj.error)))
+                return
+            if obj.error is not None:
+                await asyncio.sleep(0)  # the action may fail at once, let other tasks run
+            intended = tools.get_timestamp()
 
-    async def bound_fetch(self, sem, session, user, action):
-        async with sem:
-            await self.fetch(session, user, action)
+    async def iterate(self, index, action, intended=None):
+        """Imitate one iteration of the open model - a user arrives, does the action once and leaves."""
+        obj = self.make_action(index, action)
+        obj.intended = intended
+        await self.act(obj)
 
-    async def run_action(self, action):
-        """Start doing given action by unique users, user ids are kept in 'users.txt'."""
-        tasks = []
-        sem = asyncio.Semaphore(1000)
-        async with ClientSession() as session:
-            for i in range(*self.slave_load['users'][action]):
-                task = asyncio.ensure_future(self.bound_fetch(sem, session, self.users[i], action))
-                tasks.append(task)
-            responses = asyncio.gather(*tasks)
-            await responses
+    async def act(self, obj):
+        """Do one iteration of an action, waiting for a turn if concurrent iterations are capped."""
+        if self.cap is None:
+            await self.attempt(obj)
+            return
+        began = time.perf_counter()
+        async with self.cap:
+            obj.wait = time.perf_counter() - began
+            await self.attempt(obj)
+
+    async def attempt(self, obj):
+        """An exception raised by the action is kept in obj.error and recorded as a failed iteration
+        (by log_sql if the action is decorated with it), instead of killing the task of the user.
+        """
+        obj.error = None
+        timestamp, intended = tools.get_timestamp(), obj.intended
+        try:
+            await obj.act()
+        except Exception as err:
+            obj.error = err
+            self.recorder.record(0, timestamp, obj.action, obj.user, tools.get_timestamp() - timestamp,
+                                 tools.CODES['ActionError'], tools.error_reason(err), intended, obj.wait)
+
+    @staticmethod
+    async def stop_gracefully(tasks):
+        """Let iterations in progress complete, cancel those not completed in GRACEFUL_STOP
+        and wait CANCEL_WAIT for the cancelled ones, so that their requests are recorded as cancelled.
+        Requests of iterations which are still not over are recorded as incomplete, see Recorder.close().
+        """
+        if tasks:
+            pending = (await asyncio.wait(tasks, timeout=GRACEFUL_STOP))[1]
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=CANCEL_WAIT)
 
 
 class CrowdLoad(AsyncLoad):
@@ -67,64 +156,100 @@ class CrowdLoad(AsyncLoad):
         self.slave_name = slave_name
         self.loop = create_loop()
 
-    def schedule_load(self, duration, loop, action, delta):
-        """A method to decide for how long the task should be running,
-        the method is responsible to start and stop the task.
-        """
-        future = asyncio.ensure_future(self.run_action(action), loop=loop)
-        asyncio.wait_for(future, duration, loop=loop)
-        loop.call_later(duration, future.cancel)
-
-    def schedule(self, duration, schedule):
-        """A method to schedule all tasks of the test run."""
-        for item in schedule:
-            num_second, step_duration, users_count, action = item
-            self.loop.call_later(num_second, self.schedule_load, step_duration,
-                                 self.loop, action, users_count)
-        self.loop.call_later(duration, stop_loop, self.loop)
-        self.loop.run_forever()
+    def arm(self):
+        """Open the HTTP session in advance, so that it does not delay the start of the load."""
+        self.loop.run_until_complete(self.open_session())
+
+    def disarm(self):
+        """Release what has been prepared by arm() if the load is not going to start."""
+        self.loop.run_until_complete(self.close_session())
+        self.recorder.close()
 
     @staticmethod
-    def get_schedule(deltas, intervals, action):
-        """Schedule load changes in order to abort as less users as possible
-        when need to remove users.
-        Method calculates total duration, makes a schedule structure, generates a text description.
+    def wait_until(timestamp):
+        """Sleep until the given wall-clock moment, return how late it has been woken up."""
+        time.sleep(max(0, timestamp - tools.get_timestamp()))
+        return tools.get_timestamp() - timestamp
+
+    async def arrive(self, action, deltas, intervals, poisson):
+        """Start iterations of the action at the rate of the current step, whatever the responses are.
+        Users of the slave's range are taken in turn. Every arrival has an intended moment,
+        an arrival later than ARRIVAL_MAX_LAG is dropped: the slave cannot keep the rate.
+        Uniform arrivals of a step are at its start + n / rate, so rounding errors do not add up.
+        """
+        users = list(range(*self.slave_load['users'][action]))
+        began = time.perf_counter()
+        wall = tools.get_timestamp()
+        tasks = set()
+        due = step_end = 0.0
+        rate = i = 0
+        for delta, interval in zip(deltas, intervals):
+            rate += delta
+            start = due = max(due, step_end)
+            step_end += interval
+            count = 0  # arrivals of the step so far
+            self.recorder.scheduled = wall + due
+            while rate > 0 and users and due < step_end:
+                self.recorder.scheduled = wall + due
+                await asyncio.sleep(due - (time.perf_counter() - began))
+                lag = max(0.0, time.perf_counter() - began - due)
+                dropped = lag > ARRIVAL_MAX_LAG
+                self.recorder.record_arrival(wall + due, action, lag, dropped)
+                if not dropped:
+                    task = asyncio.ensure_future(self.iterate(users[i % len(users)], action,
+                                                              wall + due))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    i += 1
+                count += 1
+                due = due + random.expovariate(rate) if poisson else start + count / float(rate)
+        self.recorder.scheduled = None
+        await asyncio.sleep(step_end - (time.perf_counter() - began))
+        await self.stop_gracefully(tasks)
+
+    def schedule_arrivals(self, action, deltas, intervals, poisson=False):
+        """A method to run the open model for the whole test run,
+        the session is closed and buffered records are flushed once the load is over.
+        """
+        self.loop.run_until_complete(self.arrive(action, deltas, intervals, poisson))
+        self.loop.run_until_complete(self.close_session())
+        self.recorder.close()
+
+    async def pool(self, action, deltas, intervals, ramps):
+        """Keep a live set of users doing the action: each second users are added or stopped
+        one by one to reach the target count of the second, see planner.users_per_second().
+        New users of a second start evenly within the second, the last added are first to stop.
+        A stopped user completes its iteration, its id is reused once the iteration is over.
+        """
+        free = list(reversed(range(*self.slave_load['users'][action])))
+        acting = []      # (stopping event, user index) of acting users, in order of start
+        tasks = set()    # tasks of acting and stopping users
+        targets = planner.users_per_second(deltas, intervals, ramps)
+        began = time.perf_counter()
+        wall = tools.get_timestamp()
+        for second, target in enumerate(targets):
+            await asyncio.sleep(second - (time.perf_counter() - began))
+            adding = target - len(acting)
+            for i in range(adding):
+                index = free.pop()
+                stopping = asyncio.Event()
+                task = asyncio.ensure_future(self.fetch(index, action,
+                                                        wall + second + i / adding, stopping))
+                task.add_done_callback(lambda _, index=index: free.append(index))
+                task.add_done_callback(tasks.discard)
+                tasks.add(task)
+                acting.append((stopping, index))
+            while len(acting) > target:
+                acting.pop()[0].set()
+        await asyncio.sleep(len(targets) - (time.perf_counter() - began))
+        for stopping, index in acting:
+            stopping.set()
+        await self.stop_gracefully(tasks)
+
+    def schedule_users(self, action, deltas, intervals, ramps):
+        """A method to run the closed model for the whole test run,
+        the session is closed and buffered records are flushed once the load is over.
         """
-        schedule = []
-        msg = ''
-        counts = [sum(deltas[:num]) for num in range(1, len(deltas) + 1)]
-        i = m = t = 0
-        tmp = [item - m for item in counts]
-        while i < len(counts):
-            j = i       # start from i because there is no need to look back "in the past"
-            x = tmp[i]  # users count to be scheduled during this iteration
-            if x > 0:   # negative deltas will be skipped
-                msg += '\n%s%s-th second: need to have %s users doing %s:' % \
-                       ('#%s:\n' % action if t == 0 else '', t, x, action)
-                while j < len(tmp):
-                    p = j + tmp[j:].index(0) if 0 in tmp[j:] else len(tmp)  # index of next zero
-                    # q: slice from "now" to that "next" zero, should not contain zeros!
-                    # m: minimum of remaining users count and values from the slice
-                    q = [item for item in tmp[j:p]]
-                    m = min(q + [x]) if q else x
-                    if m:
-                        # k: how many time intervals users should act
-                        # d: partial duration for m users to keep acting
-                        k = tmp[j:].index(0) if 0 in tmp[j:] else len(tmp[j:])
-                        d = sum(intervals[j:j + k + 1])
-                        msg += '\n\t\t- scheduling %s users to act for %s seconds.' % (m, d)
-                        schedule.append((t, d, m, action))
-                        # now update counts of users which are still to be scheduled:
-                        for num in range(i, len(tmp)):
-                            if tmp[num] == 0:
-                                break    # no need to consider users deltas after first zero
-                            tmp[num] = tmp[num] - m  # users remaining to act after partial duration
-                    x -= m  # remaining users count
-                    j += 1
-                    if x <= 0:  # all users for this iteration are scheduled, go to next iteration
-                        break
-            else:
-                msg += '\n%s-th second: stopping %s users.' % (t, abs(deltas[i]))
-            t += intervals[i]
-            i += 1
-        return {'duration': sum(intervals), 'schedule': schedule, 'description': msg}
+        self.loop.run_until_complete(self.pool(action, deltas, intervals, ramps))
+        self.loop.run_until_complete(self.close_session())
+        self.recorder.close()
@@ -0,0 +1,91 @@
+"""Calibration of a slave: how many requests per second this host can generate.
+The real engine (CrowdLoad, Recorder) keeps a crowd of users requesting a stub target started
+in another process on the same host, so the network and servers under test play no part.
+The result is printed as JSON on the last line of the output, the master stores it in conf.yaml.
+"""
+import os
+import json
+import time
+import argparse
+from pathos.helpers import mp
+import tools
+import stub
+from action import Action
+from aload import CrowdLoad
+
+
+CALIBRATION_ID = 'calibration'
+CALIBRATION_SECONDS = 5
+CALIBRATION_USERS = 50
+
+
+class StubAction(Action):
+    """One request to the stub per iteration, the body is read and discarded."""
+    url = None
+    body_mode = 'discard'
+
+    async def act(self):
+        code, reason, _ = await self.atomic_get(self.url)
+        return code, reason
+
+
+class CalibrationLoad(CrowdLoad):
+    """Users do StubAction instead of actions from actions.py."""
+    def make_action(self, index, action):
+        obj = StubAction(self.recorder, self.session, self.users[index], action)
+        obj.position = index
+        return obj
+
+
+def calibrate(seconds=CALIBRATION_SECONDS, users=CALIBRATION_USERS):
+    """Keep users requesting the stub for a number of seconds, users do not wait between
+    iterations, so the engine runs as fast as the process can.
+    :return: a dictionary: rps - requests per second of one process, cpu_ms - CPU time of
+    the process per request (the recorder included), cores - CPU cores of the host,
+    capacity - requests per second of the host if all cores generate the load.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    tools.write_user_index(['calibration-%s' % i for i in range(users)],
+                           'users-%s.idx' % CALIBRATION_ID)
+    tools.db_init(tools.get_db_conn('%s.db' % CALIBRATION_ID))
+    port = stub.free_port()
+    target = mp.Process(target=stub.run, args=(port,), daemon=True)
+    target.start()
+    try:
+        if not stub.wait_listening(port):
+            raise RuntimeError('Stub target has not started on port %s' % port)
+        StubAction.url = 'http://127.0.0.1:%s/calibration' % port
+        load = {'users': {'StubAction': [0, users]}, 'client': {'limit': users}}
+        crowd = CalibrationLoad(CALIBRATION_ID, CALIBRATION_ID, load, 'StubAction')
+        crowd.arm()
+        began, cpu = time.perf_counter(), time.process_time()
+        crowd.schedule_users('StubAction', [users], [seconds], ['step'])
+        elapsed, cpu = time.perf_counter() - began, time.process_time() - cpu
+        overhead = crowd.recorder.overhead()
+    finally:
+        target.terminate()
+        target.join()
+        for fname in ['%s.db' % CALIBRATION_ID, 'users-%s.idx' % CALIBRATION_ID]:
+            if os.path.isfile(os.path.join(folder, fname)):
+                os.remove(os.path.join(folder, fname))
+    requests = overhead['records'] or 1
+    cpu_ms = 1000.0 * cpu / requests
+    cores = os.cpu_count() or 1
+    return {'rps': int(requests / elapsed), 'cpu_ms': round(cpu_ms, 4), 'cores': cores,
+            'capacity': int(cores * 1000.0 / cpu_ms), 'recorder_us': round(overhead['loop_us'] +
+                                                                           overhead['writer_us'], 2),
+            'timestamp': int(tools.get_timestamp())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate a CrowdBench slave.')
+    parser.add_argument('-s', '--seconds', type=int, default=CALIBRATION_SECONDS,
+                        help='how long to generate the load.')
+    parser.add_argument('-u', '--users', type=int, default=CALIBRATION_USERS,
+                        help='users requesting the stub concurrently.')
+    args = parser.parse_args()
+    print(json.dumps(calibrate(args.seconds, args.users), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Data feeders: records of test data for parameterized actions, see Action.feed().
+A data file is put into the engine folder next to actions.py: CSV with a header line
+or JSON lines (.jsonl), one record per line, blank lines are skipped.
+The file is memory-mapped and records are parsed one by one when they are asked for,
+so a big file is neither loaded nor copied into every action: one feeder per file
+is shared by all users of a process, and the pages of the file by all processes.
+"""
+import os
+import csv
+import json
+import mmap
+import random
+from array import array
+
+
+POLICIES = ['sequential', 'random', 'unique']
+
+_feeders = {}  # file name -> Feeder, in this process
+
+
+class FeederExhausted(IndexError):
+    """No 'unique' record for the user: the data file has fewer records than users.
+    The user stops, its next iterations would fail the same way, see AsyncLoad.fetch().
+    """
+
+
+class Feeder(object):
+    """Records of a data file:
+    'sequential' - in the order of the file, over again from the first one at the end;
+    'random' - any record, each time;
+    'unique' - the record at the position of the user in users.txt, so the same for the user
+    in every iteration and never the same for two users on any slave.
+    Offsets of records are collected once, at the first random or unique record asked for.
+    """
+    def __init__(self, file_name, folder=None):
+        folder = folder or os.path.dirname(os.path.abspath(__file__))
+        self.file_name = file_name
+        if not os.path.getsize(os.path.join(folder, file_name)):
+            raise ValueError('No records in %s' % file_name)
+        with open(os.path.join(folder, file_name), 'rb') as _f:
+            self.map = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = None
+        self.first = 0  # offset of the first record
+        if file_name.endswith('.csv'):
+            self.first = self.line_end(0)
+            self.header = next(csv.reader([self.map[:self.first].decode('utf-8')]))
+        self.position = self.first  # offset of the next sequential record
+        self.offsets = None
+
+    def line_end(self, offset):
+        end = self.map.find(b'\n', offset)
+        return len(self.map) if end < 0 else end + 1
+
+    def parse(self, line):
+        text = line.decode('utf-8')
+        if self.header is None:
+            return json.loads(text)
+        return dict(zip(self.header, next(csv.reader([text]))))
+
+    def record(self, offset):
+        return self.parse(self.map[offset:self.line_end(offset)].strip())
+
+    def index(self):
+        """Collect offsets of non-blank lines, 8 bytes per record."""
+        self.offsets = array('Q')
+        offset = self.first
+        while offset < len(self.map):
+            end = self.line_end(offset)
+            if self.map[offset:end].strip():
+                self.offsets.append(offset)
+            offset = end
+        if not self.offsets:
+            raise ValueError('No records in %s' % self.file_name)
+
+    def next(self, policy='sequential', position=None):
+        if policy == 'sequential':
+            return self.sequential()
+        if self.offsets is None:
+            self.index()
+        if policy == 'random':
+            return self.record(self.offsets[random.randrange(len(self.offsets))])
+        if policy == 'unique':
+            if position is None or position >= len(self.offsets):
+                raise FeederExhausted('%s has %s records, no record for the user at position %s'
+                                      % (self.file_name, len(self.offsets), position))
+            return self.record(self.offsets[position])
+        raise ValueError('Unknown policy "%s" of a data feeder, use one of: %s'
+                         % (policy, ', '.join(POLICIES)))
+
+    def sequential(self):
+        for _ in range(2):  # the second pass starts over from the first record
+            while self.position < len(self.map):
+                offset, self.position = self.position, self.line_end(self.position)
+                line = self.map[offset:self.position].strip()
+                if line:
+                    return self.parse(line)
+            self.position = self.first
+        raise ValueError('No records in %s' % self.file_name)
+
+
+def get_feeder(file_name, folder=None):
+    """Return the feeder of a data file shared in this process, open it on first use."""
+    if file_name not in _feeders:
+        _feeders[file_name] = Feeder(file_name, folder)
+    return _feeders[file_name]
@@ -1,6 +1,8 @@
+import heapq
 import random
+from itertools import accumulate
 import tools
-from aload import CrowdLoad
+import planner
 
 
 class TestMaster(object):
@@ -8,16 +10,32 @@ class TestMaster(object):
     def __init__(self, test_dict):
         self.actions = list(test_dict['actions'].keys())
         self.duration = sum(test_dict['intervals'])
+        self.mode = test_dict.get('mode', 'closed')
         self.load = self.transform_load(test_dict)
-        self.users = len(tools.load_users())
+        self.users = tools.build_user_index()
         self.conf = tools.load_conf()
         self.slaves = sorted([item['host'] for item in self.conf])
+        self.workers = {item['host']: item.get('workers', 0) for item in self.conf}
+        self.weights = self.capacities(self.conf)
         self.part = self.distribute_load()
         self.description = self.describe_test()
         self.test_run_id = tools.generate_test_run_id()
 
+    @staticmethod
+    def capacities(conf):
+        """Capacity weights of slaves: 'weight' declared in conf.yaml, slaves with no weight count
+        as 1. If no weight is declared and all slaves are calibrated, requests per second
+        they can generate are the weights, see calibrate.py. Otherwise all slaves are equal.
+        """
+        if not any(item.get('weight') for item in conf) and \
+                all(item.get('calibration') for item in conf):
+            return {item['host']: item['calibration']['capacity'] for item in conf}
+        return {item['host']: item.get('weight') or 1 for item in conf}
+
     def describe_test(self):
-        description = '\t\t\t\tTOTAL load:\n' + self.describe_load(self.load)
+        description = self.describe_client(self.load.get('client', {}))
+        description += self.describe_capacity()
+        description += '\t\t\t\tTOTAL load:\n' + self.describe_load(self.load)
         for slave in self.slaves:
             description += '\t\t\t\tPARTIAL load for Slave %s:\n' % slave
             description += self.describe_load(self.part[slave])
@@ -37,17 +55,50 @@ class TestMaster(object):
                     test_dict['actions'][action] = tmp
         return test_dict
 
+    def apportion(self, count):
+        """Order in which slaves get users (or iterations per second) one by one: the next one goes
+        to the slave with the highest weight / (2 * share + 1), i.e. the Sainte-Lague method.
+        Shares of the first N of the order are shares of slaves when N users are acting in total,
+        a share never decreases when N grows, so a slave does not stop users while the total grows.
+        """
+        heap = [(-self.weights[slave], i, slave) for i, slave in enumerate(self.slaves)]
+        heapq.heapify(heap)
+        shares = {slave: 0 for slave in self.slaves}
+        order = []
+        for _ in range(count):
+            _, i, slave = heapq.heappop(heap)
+            order.append(slave)
+            shares[slave] += 1
+            heapq.heappush(heap, (-self.weights[slave] / (2 * shares[slave] + 1), i, slave))
+        return order
+
     def distribute_load(self):
-        distrib_load = {slave: {'actions': {}, 'intervals': self.load['intervals'], 'users': {}}
+        """Split the load between slaves in proportion to their capacity weights: at every step
+        each slave has its share of the total count of users (or of arrival rate) of an action,
+        so a slave keeps the ramp shape of the total load. User ranges of slaves do not overlap.
+        """
+        distrib_load = {slave: {'actions': {}, 'intervals': self.load['intervals'], 'users': {},
+                                'mode': self.mode, 'arrivals': self.load.get('arrivals', 'uniform'),
+                                'workers': self.workers.get(slave, 0),
+                                'ramps': self.load.get('ramps', ['step'] * len(self.load['intervals'])),
+                                'client': self.load.get('client', {})}
                         for slave in self.slaves}
         for action in self.actions:
-            same_part = [delta // len(self.slaves) for delta in self.load['actions'][action]]
-            residue_part = [delta % len(self.slaves) for delta in self.load['actions'][action]]
+            counts = list(accumulate(self.load['actions'][action]))
+            order = self.apportion(max(counts + [0]))
+            shares = {slave: 0 for slave in self.slaves}
             for slave in self.slaves:
-                distrib_load[slave]['actions'].update({action: [value for value in same_part]})
-            # first slave will take also the residue load
-            for i in range(len(residue_part)):
-                distrib_load[self.slaves[0]]['actions'][action][i] += residue_part[i]
+                distrib_load[slave]['actions'][action] = []
+            previous = 0
+            for count in counts:
+                before = dict(shares)
+                for slave in order[previous:count]:
+                    shares[slave] += 1
+                for slave in order[count:previous]:
+                    shares[slave] -= 1
+                for slave in self.slaves:
+                    distrib_load[slave]['actions'][action].append(shares[slave] - before[slave])
+                previous = count
         i = 0  # used users
         for slave in self.slaves:
             for action in self.actions:
@@ -56,9 +107,45 @@ class TestMaster(object):
                 i += k
         return distrib_load
 
+    def peak_load(self, load):
+        """The peak count of acting users (or arrival rate) of all actions together."""
+        ramps = load.get('ramps') if self.mode != 'open' else None
+        plans = [planner.users_per_second(load['actions'][action], load['intervals'], ramps)
+                 for action in self.actions]
+        return max([sum(second) for second in zip(*plans)] or [0])
+
+    def describe_capacity(self):
+        """Describe how the load is split: the share of the peak load of a slave next to the share
+        of its capacity weight. In the open model the peak rate of a calibrated slave is compared
+        with its calibrated requests per second, an iteration makes at least one request.
+        """
+        total_weight = sum(self.weights.values())
+        total_peak = self.peak_load(self.load)
+        unit = 'iteration(s) per second' if self.mode == 'open' else 'user(s)'
+        description = 'Capacity of slaves, the load is split in proportion to weights:\n'
+        calibrations = {item['host']: item.get('calibration') for item in self.conf}
+        for slave in self.slaves:
+            capacity = 100.0 * self.weights[slave] / total_weight
+            peak = self.peak_load(self.part[slave])
+            share = 100.0 * peak / total_peak if total_peak else 0
+            description += '\tSlave %s: weight %s (%.1f%% of capacity), ' % \
+                           (slave, self.weights[slave], capacity)
+            description += 'peak load %s %s (%.1f%% of load)' % (peak, unit, share)
+            if calibrations[slave]:
+                description += ', calibrated at %s requests per second' % \
+                               calibrations[slave]['capacity']
+                if self.mode == 'open':
+                    description += ' (the peak rate takes %.0f%% of it or more)' % \
+                                   (100.0 * peak / (calibrations[slave]['capacity'] or 1))
+            description += '\n'
+        return description + '\n'
+
     def describe_load(self, load):
+        if self.mode == 'open':
+            return self.describe_arrivals(load)
         description = ''
         users_count = {action: 0 for action in self.actions}
+        ramps = self.load.get('ramps') or ['step'] * len(self.load['intervals'])
         i = progress = 0
         while i < len(self.load['intervals']):
             description += '%s-th second:\n' % progress
@@ -66,17 +153,62 @@ class TestMaster(object):
                 delta = load['actions'][action][i]
                 users_count.update({action: users_count[action] + delta})
                 act = 'added' if delta > 0 else 'removed'
-                description += '\tAction "%s": need %s users to be %s, ' % (action, abs(delta), act)
-                description += 'total will be %s user(s) doing this action\n' % users_count[action]
+                description += '\tAction "%s": need %s users to be %s' % (action, abs(delta), act)
+                if ramps[i] == 'linear' and delta:
+                    description += ' linearly in %s seconds' % self.load['intervals'][i]
+                description += ', total will be %s user(s) doing this action\n' % users_count[action]
+            progress += load['intervals'][i]
+            i += 1
+        description += '%s-th second: stop test run, iterations in progress are completed.\n' % \
+                       self.duration
+        for action in self.actions:
+            description += '\nUsers from range [%s, %s) will be taken for %s, ' % \
+                   (load['users'][action][0], load['users'][action][1], action)
+            description += 'the last added users are the first to be removed.\n'
+            peak, user_seconds = planner.plan_summary(load['actions'][action],
+                                                      load['intervals'], ramps)
+            description += 'At most %s user(s) at once, %s user-seconds of %s in total.\n' % \
+                           (peak, user_seconds, action)
+        description += '\n%s\n' % ('*' * 100)
+        return description
+
+    @staticmethod
+    def describe_client(client):
+        """Describe the HTTP client profile, it is applied to each process of each slave."""
+        if not client:
+            return ''
+        limits = ['%s' % (client[key] or 'no limit') for key in ['limit', 'limit_per_host']]
+        description = 'HTTP client profile (per process): %s connections in total, ' % limits[0]
+        description += '%s per host, ' % limits[1]
+        description += 'keep-alive %s, ' % ('%s seconds' % client['keepalive']
+                                             if client['keepalive'] else 'disabled')
+        description += 'DNS cache %s, ' % ('%s seconds' % client['dns_cache']
+                                            if client['dns_cache'] else 'disabled')
+        description += 'concurrent iterations: %s.\n\n' % (client['concurrency'] or 'no limit')
+        return description
+
+    def describe_arrivals(self, load):
+        """Describe the open model: deltas change arrival rates, not the number of acting users."""
+        description = 'Open model: iterations are started at a rate regardless of responses, ' \
+                      '%s arrivals.\n' % self.load.get('arrivals', 'uniform')
+        rates = {action: 0 for action in self.actions}
+        i = progress = 0
+        while i < len(self.load['intervals']):
+            description += '%s-th second:\n' % progress
+            for action in self.actions:
+                delta = load['actions'][action][i]
+                rates.update({action: rates[action] + delta})
+                description += '\tAction "%s": rate is %s by %s, ' % \
+                               (action, 'increased' if delta >= 0 else 'decreased', abs(delta))
+                description += 'total will be %s iteration(s) per second\n' % rates[action]
             progress += load['intervals'][i]
             i += 1
-        description += '\n\t\t\tTechnically, this will be scheduled as follows:'
+        description += '%s-th second: stop test run.\n' % self.duration
         for action in self.actions:
-            schedule = CrowdLoad('', '', load, action).get_schedule(load['actions'][action],
-                                                                    self.load['intervals'], action)
-            description += schedule['description']
-            description += '\n%s-th second: stop test run.\n' % schedule['duration']
-            description += '\nUsers from range [%s, %s) will be taken for %s.\n' % \
+            description += '\nUsers from range [%s, %s) will be taken in turn for %s.\n' % \
                    (load['users'][action][0], load['users'][action][1], action)
+            peak, iterations = planner.plan_summary(load['actions'][action], load['intervals'])
+            description += 'At most %s iteration(s) per second, %s iterations of %s in total.\n' % \
+                           (peak, iterations, action)
         description += '\n%s\n' % ('*' * 100)
         return description
@@ -1,10 +1,13 @@
 import os
+import gzip
+import json
 import socket
 import argparse
 import bottle
 import tools
 
 
+
 @bottle.route('/_get_chartdata', method='OPTIONS')
 @bottle.route('/_get_summary', method='OPTIONS')
 @bottle.route('/_get_logs', method='OPTIONS')
@@ -14,39 +17,247 @@ def options():
 
 @bottle.route('/_get_chartdata', method='GET')
 def get_chartdata():
-    """Collect data from a slave to build a chart on the monitoring web-page."""
+    """Collect data from a slave to build a chart on the monitoring web-page.
+    Data are read from the per-second rollup, so the cost of a poll does not grow with the run.
+    Only buckets from 'since' second (elapsed after test started) are returned,
+    'cursor' in the result is the value of 'since' to be used for the next poll.
+    """
     callback = bottle.request.query.get('callback')
-    y_axis = bottle.request.query.get('y_axis').strip()
-    w_acts = ["action='%s'" % act for act in bottle.request.query.get('actions').strip().split(',')]
-    w_acts = 'AND (%s)' % ' OR '.join(w_acts) if w_acts else ''
-    f_value = 'AVG(latency)' if y_axis.startswith('avg') else 'COUNT(timestamp)'
-    atomic = 1 if y_axis in ['aops', 'avgl'] else 0
+    results, result = query_chartdata(bottle.request.query)
+    result[bottle.request.query.slave] = results
+    return '{0}({1})'.format(callback, result)
 
-    db_conn = tools.get_db_conn('%s.db' % bottle.request.query.test_run_id)
-    sql = 'SELECT test_run_status, timestamp_started, timestamp_completed FROM info LIMIT 1'
-    status, started, finished = tools.db_query(db_conn, sql)[1][0]
+
+@bottle.route('/v%s/chartdata' % tools.PROTOCOL, method='GET')
+def get_chartdata_columns():
+    """Chart data for the master: same as _get_chartdata, but every field is an array
+    of values in the order of the 'timestamp' array, so is 'weights' of a field and 'histogram'.
+    """
+    results, result = query_chartdata(bottle.request.query)
+    result['columns'] = columns(results, result['fields'])
+    result['columns']['timestamp'] = [int(item['timestamp']) for item in results]
+    return compressed(result)
+
+
+def query_chartdata(query):
+    db_conn = tools.get_db_conn('%s.db' % query.test_run_id)
+    return collect_chartdata(db_conn, int(query.get('since') or 0), query.get('y_axis').strip(),
+                             query.get('actions').strip().split(','))
+
+
+def collect_chartdata(db_conn, since, y_axis, actions):
+    """Read chart items of a test run from 'since' second for the kind of chart in 'y_axis'.
+    The master reads harvested test runs with this function as well.
+    :return: chart items and the rest of the result: fields, merge rules, status and progress.
+    """
+    sql = 'SELECT test_run_status, timestamp_started, timestamp_completed, slave_name, ' + \
+          'start_offset FROM info LIMIT 1'
+    status, started, finished, slave_name, offset = tools.db_query(db_conn, sql)[1][0]
     progress = int(float(finished) - float(started)) if finished \
         else int(tools.get_timestamp() - float(started))
 
-    sql = 'SELECT substr(timestamp, 0, 11), code, %s FROM recs ' % f_value + \
-          'WHERE atomic=%s %s GROUP BY code, substr(timestamp, 0, 11) ' % (atomic, w_acts) + \
-          'ORDER BY id DESC LIMIT 3600'  # last 1 hour activity
-
-    result = tools.db_query(db_conn, sql)[1] if finished else tools.db_query(db_conn, sql)[1][:-1]
-    result = list(reversed(result))
-    results = {str(abs(int(item[0]) - int(float(started)))):
-               {'failed': 0, 'passed': 0, 'incomplete': 0} for item in result}
-    for item in result:  # item[0] - timestamp, item[1] - code (None if incomplete), item[2] - value
-        timestamp = str(int(item[0]) - int(float(started)))
-        value = item[2] or 0
-        results[timestamp]['failed'] += value if item[1] and item[1] != 200 else 0
-        results[timestamp]['passed'] += value if item[1] == 200 else 0
-        results[timestamp]['incomplete'] += value if item[1] == None else 0
-    results = [{'timestamp': key, 'failed': value['failed'], 'passed': value['passed'],
-                'incomplete': value['incomplete']} for key, value in results.items()]
-    result = {bottle.request.query.slave: results, 'status': status,
-              'started': started, 'finished': finished or '(not finished)', 'progress': progress}
-    return '{0}({1})'.format(callback, result)
+    # last 1 hour activity, the current second is skipped while it is still being filled
+    first = int(float(started))
+    last = int(float(finished)) + 1 if finished else int(tools.get_timestamp())
+    cursor = last - first if finished else open_cursor(db_conn, since, first, last)
+    if y_axis == 'sched':
+        results, fields, merge = read_arrivals(db_conn, actions, first, since, last)
+    elif y_axis == 'net':
+        results, fields, merge = read_network(db_conn, actions, first, since, last)
+    elif y_axis == 'pool':
+        results, fields, merge = read_waits(db_conn, actions, first, since, last)
+    elif y_axis in ['pctl', 'pctd']:
+        results, fields, merge = read_percentiles(db_conn, actions, first, since, last, y_axis)
+    elif y_axis in ['cavl', 'cavd']:
+        results, fields, merge = read_corrected(db_conn, actions, first, since, last, y_axis)
+    else:
+        results, fields, merge = read_rollup(db_conn, actions, first, since, last, y_axis)
+    return results, {'fields': fields, 'merge': merge, 'status': status, 'cursor': cursor,
+                     'started': started, 'finished': finished or '(not finished)',
+                     'progress': progress,
+                     'offsets': {slave_name: '(not started)' if offset is None else offset}}
+
+
+def open_cursor(db_conn, since, first, last):
+    """Buckets keep changing while requests started at their second complete, so the cursor
+    of a test run in progress is the earliest second any recorder may still write, see tools.Recorder.
+    It stays at 'since' until recorders are there, it is the end once all of them are closed.
+    """
+    rows = tools.db_query(db_conn, 'SELECT COUNT(*), MIN(open_from) FROM writers')[1]
+    writers, open_from = rows[0] if rows else (0, None)
+    if not writers:
+        return since
+    if open_from is None:
+        return last - first
+    return max(0, min(last, open_from) - first)
+
+
+def columns(items, fields):
+    """Turn a list of items into a dictionary of arrays, one array per field.
+    Nested 'weights' of items become arrays as well, 'histogram' becomes an array of histograms,
+    'low' (the minimum bounding percentiles) an array of values.
+    """
+    result = {field: [item[field] for item in items] for field in fields}
+    if items and 'weights' in items[0]:
+        result['weights'] = {field: [item['weights'][field] for item in items]
+                             for field in items[0]['weights']}
+    for key in ['histogram', 'low']:
+        if items and key in items[0]:
+            result[key] = [item[key] for item in items]
+    return result
+
+
+def compressed(result):
+    """A response of the machine endpoints: gzip-compressed JSON with the protocol version."""
+    result['version'] = tools.PROTOCOL
+    bottle.response.content_type = 'application/json'
+    bottle.response.set_header('Content-Encoding', 'gzip')
+    return gzip.compress(json.dumps(result, separators=(',', ':')).encode('utf-8'), 5)
+
+
+def read_rollup(db_conn, actions, first, since, last, y_axis):
+    """Read counts or average latencies of requests per second from the rollup table.
+    Averages are merged between slaves weighted by counts of requests of the same kind.
+    :return: chart items, names of the fields and how to merge the fields between slaves.
+    """
+    average = y_axis.startswith('avg')
+    atomic = 1 if y_axis in ['aops', 'avgl'] else 0
+    sql = 'SELECT second, code, SUM(count), SUM(latency_sum) FROM rollup ' + \
+          'WHERE atomic = ? AND second >= ? AND second < ? ' + \
+          'AND action IN (%s) GROUP BY second, code' % ', '.join('?' * len(actions))
+    result = tools.db_query(db_conn, sql,
+                            [atomic, max(first + since, last - 3600), last] + actions)[1]
+
+    fields = ['failed', 'passed', 'incomplete']
+    counts = {}
+    latencies = {}
+    for second, code, count, latency in sorted(result, key=lambda item: item[0]):
+        timestamp = str(second - first)
+        if timestamp not in counts:
+            counts[timestamp] = {field: 0 for field in fields}
+            latencies[timestamp] = {field: 0.0 for field in fields}
+        key = 'incomplete' if code is None else 'passed' if code == 200 else 'failed'
+        counts[timestamp][key] += count
+        latencies[timestamp][key] += latency
+    results = []
+    for timestamp, value in counts.items():
+        item = {'timestamp': timestamp}
+        for key, count in value.items():
+            item[key] = (latencies[timestamp][key] / count if count else 0) if average else count
+        if average:
+            item['weights'] = value
+        results.append(item)
+    return results, fields, {field: 'mean' for field in fields} if average else {}
+
+
+def read_corrected(db_conn, actions, first, since, last, y_axis):
+    """Read raw and corrected latencies of completed requests per second, in milliseconds.
+    Corrected latency counts from the intended start, see tools.rollup_records().
+    Averages are merged between slaves weighted by counts of requests.
+    """
+    atomic = 1 if y_axis == 'cavl' else 0
+    sql = 'SELECT second, SUM(count), SUM(latency_sum), SUM(corrected_sum), ' + \
+          'MAX(latency_max), MAX(corrected_max) FROM rollup ' + \
+          'WHERE atomic = ? AND code IS NOT NULL AND second >= ? AND second < ? ' + \
+          'AND action IN (%s) GROUP BY second' % ', '.join('?' * len(actions))
+    result = tools.db_query(db_conn, sql,
+                            [atomic, max(first + since, last - 3600), last] + actions)[1]
+    results = [{'timestamp': str(second - first),
+                'weights': {'average': count, 'corrected': count},
+                'average': round(total * 1000 / count, 3),
+                'corrected': round(corrected * 1000 / count, 3),
+                'max': round(high * 1000, 3), 'corrected_max': round(worst * 1000, 3)}
+               for second, count, total, corrected, high, worst in sorted(result) if count]
+    merge = {'average': 'mean', 'corrected': 'mean', 'max': 'max', 'corrected_max': 'max'}
+    return results, ['average', 'corrected', 'max', 'corrected_max'], merge
+
+
+def read_network(db_conn, actions, first, since, last):
+    """Read network throughput per second in kilobytes received and sent by atomic requests,
+    next to the count of atomic requests; requests are counted by the second they started at.
+    """
+    sql = 'SELECT second, SUM(count), SUM(bytes_in), SUM(bytes_out) FROM rollup ' + \
+          'WHERE atomic = 1 AND second >= ? AND second < ? ' + \
+          'AND action IN (%s) GROUP BY second' % ', '.join('?' * len(actions))
+    result = tools.db_query(db_conn, sql, [max(first + since, last - 3600), last] + actions)[1]
+    results = [{'timestamp': str(second - first), 'requests': count,
+                'kb_in': round(received / 1024.0, 3), 'kb_out': round(sent / 1024.0, 3)}
+               for second, count, received, sent in sorted(result)]
+    return results, ['requests', 'kb_in', 'kb_out'], {}
+
+
+def read_waits(db_conn, actions, first, since, last):
+    """Read where completed requests spend time, average per second in milliseconds:
+    waiting for a pooled connection (the generator is the bottleneck) or for the server
+    (the target is the bottleneck); transactions waiting for the concurrency cap.
+    """
+    sql = 'SELECT second, atomic, SUM(count), SUM(latency_sum), SUM(wait_sum) FROM rollup ' + \
+          'WHERE code IS NOT NULL AND second >= ? AND second < ? ' + \
+          'AND action IN (%s) GROUP BY second, atomic' % ', '.join('?' * len(actions))
+    result = tools.db_query(db_conn, sql, [max(first + since, last - 3600), last] + actions)[1]
+    fields = ['connection_wait', 'server_wait', 'cap_wait']
+    items = {}
+    for second, atomic, count, latency, wait in sorted(result):
+        timestamp = str(second - first)
+        if timestamp not in items:
+            items[timestamp] = {'timestamp': timestamp, 'weights': {field: 0 for field in fields}}
+            items[timestamp].update({field: 0 for field in fields})
+        item = items[timestamp]
+        if atomic:
+            item['connection_wait'] = round(wait * 1000 / count, 3)
+            item['server_wait'] = round((latency - wait) * 1000 / count, 3)
+            item['weights'].update({'connection_wait': count, 'server_wait': count})
+        else:
+            item['cap_wait'] = round(wait * 1000 / count, 3)
+            item['weights'].update({'cap_wait': count})
+    return list(items.values()), fields, {field: 'mean' for field in fields}
+
+
+def read_percentiles(db_conn, actions, first, since, last, y_axis):
+    """Read percentiles of latency of completed requests per second, in milliseconds.
+    Histograms are returned as well, so that the master merges them between slaves
+    instead of merging percentiles; minimum ('low') and maximum are exact, they are taken
+    from the rollup and bound percentiles of the second.
+    """
+    atomic = 1 if y_axis == 'pctl' else 0
+    params = [atomic, max(first + since, last - 3600), last] + actions
+    where = 'WHERE atomic = ? AND second >= ? AND second < ? ' + \
+            'AND action IN (%s) ' % ', '.join('?' * len(actions))
+    sql = 'SELECT second, bucket, SUM(count) FROM histograms ' + where + 'GROUP BY second, bucket'
+    histograms = {}
+    for second, bucket, count in tools.db_query(db_conn, sql, params)[1]:
+        histograms.setdefault(second, {})[bucket] = count
+    sql = 'SELECT second, MIN(latency_min), MAX(latency_max) FROM rollup ' + where + \
+          'AND code IS NOT NULL GROUP BY second'
+    bounds = {second: (low, high) for second, low, high in tools.db_query(db_conn, sql, params)[1]}
+    fields = [tools.percentile_field(percentile) for percentile in tools.PERCENTILES] + ['max']
+    results = []
+    for second in sorted(histograms):
+        low, high = bounds.get(second, (None, None))
+        item = {'timestamp': str(second - first),
+                'histogram': [[bucket, count] for bucket, count in sorted(histograms[second].items())],
+                'low': round((low or 0) * 1000, 3), 'max': round((high or 0) * 1000, 3)}
+        for percentile, value in tools.histogram_percentiles(histograms[second],
+                                                             low=low, high=high).items():
+            item[tools.percentile_field(percentile)] = round(value * 1000, 3)
+        results.append(item)
+    merge = {field: 'histogram' for field in fields[:-1]}
+    merge['max'] = 'max'
+    return results, fields, merge
+
+
+def read_arrivals(db_conn, actions, first, since, last):
+    """Read arrivals of the open model per second: started and dropped iterations,
+    the worst scheduler lag in milliseconds - it is merged between slaves as maximum.
+    """
+    sql = 'SELECT second, SUM(started), SUM(dropped), MAX(lag_max) FROM arrivals ' + \
+          'WHERE second >= ? AND second < ? ' + \
+          'AND action IN (%s) GROUP BY second' % ', '.join('?' * len(actions))
+    result = tools.db_query(db_conn, sql, [max(first + since, last - 3600), last] + actions)[1]
+    results = [{'timestamp': str(second - first), 'started': started, 'dropped': dropped,
+                'lag_max': round(lag * 1000, 3)}
+               for second, started, dropped, lag in sorted(result)]
+    return results, ['started', 'dropped', 'lag_max'], {'lag_max': 'max'}
 
 
 @bottle.route('/_get_summary', method='GET')
@@ -54,19 +265,61 @@ def get_summary():
     """Collect summary of responses from a slave to display it on the monitoring web-page."""
     callback = bottle.request.query.get('callback')
     db_conn = tools.get_db_conn('%s.db' % bottle.request.query.test_run_id)
-    sql = 'SELECT code, reason, COUNT(*) FROM recs GROUP BY reason'
+    return '{0}({1})'.format(callback, collect_summary(db_conn))
+
+
+@bottle.route('/v%s/summary' % tools.PROTOCOL, method='GET')
+def get_summary_columns():
+    """Summary of responses for the master: arrays of reasons, codes and counts."""
+    db_conn = tools.get_db_conn('%s.db' % bottle.request.query.test_run_id)
+    return compressed({'columns': columns(collect_summary(db_conn), ['reason', 'code', 'count'])})
+
+
+def collect_summary(db_conn):
+    sql = 'SELECT code, reason, SUM(count) FROM reasons GROUP BY reason'
     result = tools.db_query(db_conn, sql)[1]
-    results = [{'reason': item[1] or 'Incompleted (still running or aborted)',
-                'count': item[2], 'code': str(item[0])} for item in result if item[2]]
-    return '{0}({1})'.format(callback, results)
+    return [{'reason': item[1] or 'Incompleted (still running or aborted)',
+             'count': item[2], 'code': str(item[0])} for item in result if item[2]]
+
+
+@bottle.route('/v%s/harvest' % tools.PROTOCOL, method='GET')
+def get_harvest():
+    """Rows of a table of a test run for the master to keep once the test run is over,
+    a page of 'limit' rows after 'after' rowid; 'cursor' is the value of 'after' for the next page,
+    the last page has less than 'limit' rows.
+    """
+    table = bottle.request.query.get('table')
+    if table not in tools.HARVEST_TABLES:
+        bottle.abort(404, 'No table %s to harvest' % table)
+    db_conn = tools.get_db_conn('%s.db' % bottle.request.query.test_run_id)
+    after = int(bottle.request.query.get('after') or 0)
+    limit = int(bottle.request.query.get('limit') or 10000)
+    cur = db_conn.execute('SELECT rowid AS harvest_rowid, * FROM %s WHERE rowid > ? '
+                          'ORDER BY rowid LIMIT ?' % table, (after, limit))
+    names = [item[0] for item in cur.description]
+    rows = [dict(zip(names, row)) for row in cur.fetchall()]
+    return compressed({'table': table, 'count': len(rows),
+                       'cursor': rows[-1]['harvest_rowid'] if rows else after,
+                       'columns': columns(rows, [name for name in names
+                                                 if name not in ['harvest_rowid', 'id']])})
 
 
 @bottle.route('/_get_logs', method='GET')
 def get_logs():
     """Collect logs from monitor.py and slave.py from a slave."""
     callback = bottle.request.query.get('callback')
+    return '{0}({1})'.format(callback, [collect_logs(bottle.request.query)])
+
+
+@bottle.route('/v%s/logs' % tools.PROTOCOL, method='GET')
+def get_logs_columns():
+    """Logs for the master, there is nothing to put in columns."""
+    return compressed(collect_logs(bottle.request.query))
+
+
+def collect_logs(query):
     folder = os.path.dirname(os.path.abspath(__file__))
-    test_run_title = bottle.request.query.test_run_id
+    test_run_title = query.test_run_id
     results = {'logs': {'monitor': '', 'testrun': ''}, 'host': bottle.request.headers.get('host')}
     try:
         with open(os.path.join(folder, 'monitor.log'), 'r+') as _f:
@@ -76,7 +329,7 @@ def get_logs():
     except IOError as err:
         key = 'monitor' if 'monitor' in str(err) else 'testrun'
         results['logs'].update({key: 'Could not find logs: %s' % err})
-    return '{0}({1})'.format(callback, [results])
+    return results
 
 
 def main():
@@ -0,0 +1,39 @@
+"""Plans of the load: what an action process should reach every second of a test run.
+Plans depend on deltas, intervals and ramps only, slaves and their processes usually
+share them, so a plan is calculated once per process and then taken from the cache.
+"""
+from functools import lru_cache
+
+
+PLANS_CACHED = 256
+
+
+def users_per_second(deltas, intervals, ramps=None):
+    """Target count of acting users (or arrival rate of the open model) for every second:
+    a step changes the count at once ('step') or evenly during the step ('linear').
+    :return: a tuple of counts, one per second of the test run.
+    """
+    ramps = ramps or ['step'] * len(intervals)
+    return _users_per_second(tuple(deltas), tuple(intervals), tuple(ramps))
+
+
+@lru_cache(maxsize=PLANS_CACHED)
+def _users_per_second(deltas, intervals, ramps):
+    """Linear in the duration of the test run: each second is visited once."""
+    targets = []
+    count = 0
+    for delta, interval, ramp in zip(deltas, intervals, ramps):
+        if ramp == 'linear':
+            targets.extend([count + delta * (num + 1) // interval for num in range(interval)])
+        else:
+            targets.extend([count + delta] * interval)
+        count += delta
+    return tuple(targets)
+
+
+def plan_summary(deltas, intervals, ramps=None):
+    """The peak count and the sum of counts over all seconds: user-seconds of the closed model,
+    iterations of the open model.
+    """
+    targets = users_per_second(deltas, intervals, ramps)
+    return max(targets or [0]), sum(targets)
@@ -1,15 +1,28 @@
+import os
+import time
+import queue
 import argparse
 import json
 from pathos.helpers import mp
 import tools
+import planner
 from aload import CrowdLoad
 
 
+ARM_TIMEOUT = 60    # seconds for all action processes to get ready
+FIRE_TIMEOUT = 120  # seconds to wait for the master to fire after the slave is armed
+
+
 class TestSlave(object):
-    """A class responsible for a test run using multiprocessing - one process per action."""
+    """A class responsible for a test run using multiprocessing - each action is run by
+    one or more processes (shards), every shard takes its own part of the action's users.
+    A test run starts in two phases: the slave is armed (processes are spawned, plans are made,
+    sessions are opened) and then all slaves are fired at the same moment chosen by the master.
+    """
     def __init__(self, slave_name, test_run_id, load_fname):
         self.name = slave_name
         self.test_run_id = test_run_id
+        self.folder = os.path.dirname(os.path.abspath(__file__))
         self.test = tools.load_testrun_data(load_fname)
         self.load = self.test[slave_name]
         self.intervals = self.load['intervals']
@@ -21,37 +34,133 @@ class TestSlave(object):
         conn = tools.get_db_conn('%s.db' % self.test_run_id)
         tools.db_init(conn)
         sql = "INSERT INTO info " + \
-              "(test_run_id, slave_name, timestamp_started, total_load_info, slave_load_info) " + \
-              "VALUES ('%s', '%s', '%s', '%s', '%s')"
+              "(test_run_id, test_run_status, slave_name, timestamp_started, " + \
+              "total_load_info, slave_load_info) VALUES ('%s', 'ARMING', '%s', '%s', '%s', '%s')"
         tools.db_query(conn, sql % (self.test_run_id, self.name, tools.get_timestamp(),
                                     json.dumps(self.test, sort_keys=True, indent=4),
                                     json.dumps(self.load, sort_keys=True, indent=4)))
 
+    def arm(self):
+        """Tell the master the slave is ready: the master polls for '<test_run_id>.armed' file."""
+        tools.db_query(tools.get_db_conn('%s.db' % self.test_run_id),
+                       "UPDATE info SET test_run_status = 'ARMED'")
+        with open(os.path.join(self.folder, '%s.armed' % self.test_run_id), 'w') as _f:
+            _f.write(str(tools.get_timestamp()))
+
+    def wait_fire(self):
+        """Wait for the master to write '<test_run_id>.fire' file with the moment to start at.
+        :return: a timestamp to start at, 0 if the master aborted the test run or did not fire.
+        """
+        fname = os.path.join(self.folder, '%s.fire' % self.test_run_id)
+        deadline = tools.get_timestamp() + FIRE_TIMEOUT
+        while tools.get_timestamp() < deadline:
+            if os.path.isfile(fname):
+                with open(fname, 'r') as _f:
+                    return float(_f.read().strip() or 0)
+            time.sleep(0.01)
+        return 0
+
+    def fire(self, fire_at):
+        """Timeline of the test run on every slave starts at the moment chosen by the master."""
+        tools.db_query(tools.get_db_conn('%s.db' % self.test_run_id),
+                       "UPDATE info SET test_run_status = 'IN PROGRESS', fire_at = ?, "
+                       "timestamp_started = ?", (fire_at, fire_at))
+
+    def record_offset(self, offset):
+        """Keep the worst start offset among action processes, to make slaves skew visible."""
+        tools.db_query(tools.get_db_conn('%s.db' % self.test_run_id),
+                       'UPDATE info SET start_offset = MAX(COALESCE(start_offset, ?), ?)',
+                       (offset, offset))
+
+    def abort(self):
+        tools.db_query(tools.get_db_conn('%s.db' % self.test_run_id),
+                       "UPDATE info SET test_run_status = 'ABORTED', timestamp_completed = '%s'"
+                       % tools.get_timestamp())
+
     def complete(self):
         """Update a local test-run database on the slave once test run is completed."""
         tools.db_query(tools.get_db_conn('%s.db' % self.test_run_id),
                        "UPDATE info SET test_run_status = 'FINISHED', timestamp_completed = '%s'"
                        % tools.get_timestamp())
 
-    def worker(self, action, send_end):
-        """Method to execute one action in a loop by one user, in one process."""
-        crowd = CrowdLoad(self.name, self.test_run_id, self.load, action)
-        schedule_dict = crowd.get_schedule(self.load['actions'][action], self.intervals, action)
-        crowd.schedule(self.duration, schedule_dict['schedule'])
+    def shards_count(self, action):
+        """Processes per action: 'workers' from conf.yaml of the slave,
+        or CPU cores shared between actions; a process gets at least one user.
+        """
+        workers = self.load.get('workers') or (os.cpu_count() or 1) // len(self.load['actions'])
+        users = self.load['users'][action][1] - self.load['users'][action][0]
+        return max(1, min(workers, users))
+
+    def shard_loads(self, action):
+        """Split the load of an action between processes: at every step each shard has
+        a proportional part of users (or of arrival rate), user ranges of shards do not overlap.
+        """
+        shards = self.shards_count(action)
+        deltas = self.load['actions'][action]
+        counts = [sum(deltas[:num]) for num in range(1, len(deltas) + 1)]
+        first = self.load['users'][action][0]
+        loads = []
+        for i in range(shards):
+            part = [count // shards + (1 if i < count % shards else 0) for count in counts]
+            part_deltas = [count - previous for count, previous in zip(part, [0] + part[:-1])]
+            users = sum([delta for delta in part_deltas if delta > 0])
+            loads.append(dict(self.load, actions={action: part_deltas},
+                              users={action: [first, first + users]}))
+            first += users
+        return loads
+
+    def worker(self, action, load, armed, fired, fire_at, offsets):
+        """Method to execute one action in a loop by users of one shard, in one process."""
+        crowd = CrowdLoad(self.name, self.test_run_id, load, action)
+        crowd.arm()
+        ramps = self.load.get('ramps') or ['step'] * len(self.intervals)
+        if self.load.get('mode') != 'open':  # the plan is cached, not calculated once fired
+            planner.users_per_second(load['actions'][action], self.intervals, ramps)
+        armed.release()
+        fired.wait()
+        if not fire_at.value:
+            crowd.disarm()
+            return
+        offsets.put(crowd.wait_until(fire_at.value))
+        if self.load.get('mode') == 'open':
+            crowd.schedule_arrivals(action, load['actions'][action], self.intervals,
+                                    self.load.get('arrivals') == 'poisson')
+        else:
+            crowd.schedule_users(action, load['actions'][action], self.intervals, ramps)
 
     def processor(self):
-        """A method to execute load - a separate process is spawned for each action."""
-        pipe_list = []
+        """A method to execute load - separate processes are spawned for each action.
+        :return: True if the test run has been fired, False if it has been aborted.
+        """
+        armed = mp.Semaphore(0)
+        fired = mp.Event()
+        fire_at = mp.Value('d', 0.0)
+        offsets = mp.Queue()
         actions_processes = []
         for action in list(self.load['actions'].keys()):
-            recv_end, send_end = mp.Pipe(False)
-            proc = mp.Process(target=self.worker, args=(action, send_end))
-            actions_processes.append(proc)
-            pipe_list.append(recv_end)
+            for load in self.shard_loads(action):
+                proc = mp.Process(target=self.worker,
+                                  args=(action, load, armed, fired, fire_at, offsets))
+                actions_processes.append(proc)
+        print('%s Processes: %s\n' % (tools.log_timestamp_str(), len(actions_processes)))
         for proc in actions_processes:
             proc.start()
+        if all(armed.acquire(timeout=ARM_TIMEOUT) for _ in actions_processes):
+            self.arm()
+            print('%s Armed\n' % tools.log_timestamp_str())
+            fire_at.value = self.wait_fire()
+        fired.set()
+        if fire_at.value:
+            self.fire(fire_at.value)
+            print('%s Started\n' % tools.log_timestamp_str())
+            for _ in actions_processes:
+                try:
+                    self.record_offset(offsets.get(timeout=FIRE_TIMEOUT))
+                except queue.Empty:  # an action process has failed
+                    break
         for proc in actions_processes:
             proc.join()
+        return bool(fire_at.value)
 
 
 def main():
@@ -67,11 +176,13 @@ def main():
     args = vars(parser.parse_args())
 
     test_obj = TestSlave(args['name'], args['testrunid'], args['file'])
-    test_obj.start()
-    print('%s Started\n' % tools.log_timestamp_str())
-    test_obj.processor()
-    print('\n%s Stopped\n' % tools.log_timestamp_str())
-    test_obj.complete()
+    print('%s Arming\n' % tools.log_timestamp_str())
+    if test_obj.processor():
+        print('\n%s Stopped\n' % tools.log_timestamp_str())
+        test_obj.complete()
+    else:
+        print('\n%s Aborted: not armed or not fired in time\n' % tools.log_timestamp_str())
+        test_obj.abort()
 
 
 if __name__ == '__main__':
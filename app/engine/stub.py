@@ -0,0 +1,62 @@
+"""A stub HTTP target on the local host, to measure the engine itself without network and servers:
+any method and path is answered with 200 and a body of the given size after the given latency.
+Used by calibrate.py on slaves and by the benchmarks of the engine.
+"""
+import time
+import socket
+import asyncio
+import argparse
+from aiohttp import web
+
+
+def make_app(latency=0.0, size=0):
+    body = b'x' * size
+
+    async def handle(request):
+        await request.read()
+        if latency:
+            await asyncio.sleep(latency)
+        return web.Response(body=body)
+
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handle)
+    return app
+
+
+def run(port, latency=0.0, size=0, host='127.0.0.1', reuse_port=False):
+    """Serve until the process is terminated, with reuse_port processes can share the port (Linux)."""
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    web.run_app(make_app(latency, size), host=host, port=port, print=None, access_log=None,
+                reuse_port=reuse_port)
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(port, timeout=10, host='127.0.0.1'):
+    """Wait until a stub started in another process accepts connections."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub HTTP target for CrowdBench engine.')
+    parser.add_argument('-p', '--port', type=int, default=18000, help='port to listen on.')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='seconds to wait before each response.')
+    parser.add_argument('-s', '--size', type=int, default=0, help='bytes in each response body.')
+    args = parser.parse_args()
+    run(args.port, args.latency, args.size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,37 @@
 """Common functions and classes."""
 import os
+import mmap
+import struct
+import math
 import datetime
 import time
 import json
 import yaml
 import sqlite3
+import threading
 
 
 CODES = {'CancelledError': 0,  # can appear and this is in normal
          # all below exceptions should not appear, try to decrease load then:
          'ServerDisconnectedError': -1,
          'ClientOSError': -2,
+         # an exception raised by an action itself (e.g. a data feeder out of records):
+         'ActionError': -3,
          }
 
+HISTOGRAM_MIN = 0.000001  # seconds, shorter latencies fall into the first bucket
+HISTOGRAM_GROWTH = 1.04   # each bucket is 4% wider than the previous one, values are within 2%
+PERCENTILES = [50, 90, 95, 99, 99.9]
+PROTOCOL = 1  # version of the machine endpoints of monitor.py, /v<PROTOCOL>/...
+HARVEST_TABLES = ['info', 'rollup', 'reasons', 'histograms', 'arrivals', 'recs']  # copied by the master
+USERS_MAGIC = b'CBU1'
+USERS_HEADER = struct.Struct('<4sQQ')  # magic, index of the first user, count of users
+USERS_OFFSET = struct.Struct('<Q')     # offsets of user ids in the data, count + 1 of them
+DB_BUSY_TIMEOUT = 10      # seconds the recorder waits for a lock of the database
+FLUSH_ATTEMPTS = 3        # a batch of records is dropped after failing to be written this many times
+FLUSH_RETRY_DELAY = 1.0   # seconds before the next attempt, growing with each attempt
+DROPPED_REASON = 'Dropped by the recorder (database errors)'  # a reason in the summary
+
 
 def get_timestamp():
     return time.time()
@@ -50,7 +69,7 @@ def load_conf(file_name='conf.yaml'):
     hosts = []
     if os.path.isfile(file_name):
         with open(file_name, 'r+') as _f:
-            hosts = yaml.load(_f.read())['hosts']
+            hosts = yaml.safe_load(_f.read())['hosts']
     return hosts
 
 
@@ -61,25 +80,85 @@ def save_conf(hosts, file_name='conf.yaml'):
     return True
 
 
-def load_users(file_name='users.txt', folder=None):
-    """A function reads users ids from a txt-file stored on master in app/engine folder."""
-    lines = []
+class UserIndex(object):
+    """Read-only user ids from an index file, see write_user_index(). The file is memory-mapped,
+    so a process only loads pages of the users it reads and the pages are shared between processes.
+    Users are addressed by their position in users.txt, a slice knows the position it starts at.
+    """
+    def __init__(self, file_name='users.idx', folder=None):
+        folder = folder or os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(folder, file_name), 'rb') as _f:
+            self.map = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.first, self.count = USERS_HEADER.unpack_from(self.map)
+        if magic != USERS_MAGIC:
+            raise ValueError('%s is not an index of users' % file_name)
+        self.data = USERS_HEADER.size + USERS_OFFSET.size * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        position = index - self.first
+        if not 0 <= position < self.count:
+            raise IndexError('user %s is out of the index [%s, %s)'
+                             % (index, self.first, self.first + self.count))
+        offset = USERS_HEADER.size + USERS_OFFSET.size * position
+        start, end = struct.unpack_from('<QQ', self.map, offset)
+        return self.map[self.data + start:self.data + end].decode('utf-8')
+
+    def close(self):
+        self.map.close()
+
+
+def write_user_index(users, file_name, folder=None, first=0):
+    """Write user ids into an index file: a header, offsets of ids and ids in UTF-8.
+    A temporary file is renamed at the end, so readers never see a partial index.
+    """
     folder = folder or os.path.dirname(os.path.abspath(__file__))
     file_name = os.path.join(folder, file_name)
-    if os.path.isfile(file_name):
-        with open(file_name, 'r') as _f:
-            lines = _f.readlines()
-    users = list(set([line.strip() for line in lines if line.strip()]))
-    if len(lines) != len(users):
-        with open(file_name, 'w') as _f:
-            _f.write('\n'.join(users))
-    return users
-
-
-def get_db_conn(file_name, folder=None):
+    data = [user.encode('utf-8') for user in users]
+    offsets = [0]
+    for item in data:
+        offsets.append(offsets[-1] + len(item))
+    with open(file_name + '.tmp', 'wb') as _f:
+        _f.write(USERS_HEADER.pack(USERS_MAGIC, first, len(data)))
+        _f.write(struct.pack('<%sQ' % len(offsets), *offsets))
+        _f.write(b''.join(data))
+    os.replace(file_name + '.tmp', file_name)
+
+
+def build_user_index(source='users.txt', target='users.idx', folder=None):
+    """Build the index of users from a text file with a user id per line, unless it is up-to-date.
+    Blank lines and repeated ids are skipped, the order of the first occurrences is kept,
+    so the same position names the same user on every slave and in every process.
+    :return: the count of users.
+    """
+    folder = folder or os.path.dirname(os.path.abspath(__file__))
+    source, target = os.path.join(folder, source), os.path.join(folder, target)
+    if not os.path.isfile(target) or \
+            os.path.isfile(source) and os.path.getmtime(source) > os.path.getmtime(target):
+        users = []
+        if os.path.isfile(source):
+            with open(source, 'r') as _f:
+                users = list(dict.fromkeys(line.strip() for line in _f if line.strip()))
+        write_user_index(users, target)
+    index = UserIndex(target)
+    index.close()
+    return index.count
+
+
+def slice_user_index(first, last, target, source='users.idx', folder=None):
+    """Write users from position 'first' up to 'last' (not included) of an index into a new index."""
+    index = UserIndex(source, folder)
+    last = min(last, index.first + index.count)
+    write_user_index([index[position] for position in range(first, last)], target, folder, first)
+    index.close()
+
+
+def get_db_conn(file_name, folder=None, timeout=5.0):
     folder = folder or os.path.dirname(os.path.abspath(__file__))
     db = os.path.join(folder, file_name)
-    db_conn = sqlite3.connect(db)
+    db_conn = sqlite3.connect(db, timeout=timeout)
     return db_conn
 
 
@@ -92,7 +171,11 @@ def db_init(db_conn):
                              user TEXT, \
                              latency TEXT default NULL, \
                              code INTEGER default NULL, \
-                             reason TEXT default NULL);''',
+                             reason TEXT default NULL, \
+                             intended TEXT default NULL, \
+                             wait REAL default 0, \
+                             bytes_in INTEGER default 0, \
+                             bytes_out INTEGER default 0);''',
             '''CREATE TABLE IF NOT EXISTS info (\
                              id INTEGER PRIMARY KEY, \
                              test_run_id TEXT NOT NULL, \
@@ -101,19 +184,63 @@ def db_init(db_conn):
                              timestamp_started TEXT NOT NULL, \
                              timestamp_completed TEXT, \
                              total_load_info TEXT,
-                             slave_load_info TEXT);''',
+                             slave_load_info TEXT,
+                             fire_at TEXT default NULL,
+                             start_offset REAL default NULL);''',
+            '''CREATE TABLE IF NOT EXISTS rollup (\
+                             second INTEGER NOT NULL, \
+                             action TEXT NOT NULL, \
+                             atomic BOOLEAN NOT NULL, \
+                             code INTEGER default NULL, \
+                             count INTEGER default 0, \
+                             latency_sum REAL default 0, \
+                             latency_min REAL default NULL, \
+                             latency_max REAL default NULL, \
+                             corrected_sum REAL default 0, \
+                             corrected_max REAL default NULL, \
+                             wait_sum REAL default 0, \
+                             bytes_in INTEGER default 0, \
+                             bytes_out INTEGER default 0);''',
+            'CREATE INDEX IF NOT EXISTS rollup_key ON rollup (second, action, atomic, code);',
+            '''CREATE TABLE IF NOT EXISTS reasons (\
+                             code INTEGER default NULL, \
+                             reason TEXT default NULL, \
+                             count INTEGER default 0);''',
+            '''CREATE TABLE IF NOT EXISTS arrivals (\
+                             second INTEGER NOT NULL, \
+                             action TEXT NOT NULL, \
+                             started INTEGER default 0, \
+                             dropped INTEGER default 0, \
+                             lag_sum REAL default 0, \
+                             lag_max REAL default 0, \
+                             PRIMARY KEY (second, action));''',
+            '''CREATE TABLE IF NOT EXISTS writers (\
+                             pid INTEGER PRIMARY KEY, \
+                             open_from INTEGER default NULL);''',
+            '''CREATE TABLE IF NOT EXISTS histograms (\
+                             second INTEGER NOT NULL, \
+                             action TEXT NOT NULL, \
+                             atomic BOOLEAN NOT NULL, \
+                             bucket INTEGER NOT NULL, \
+                             count INTEGER default 0, \
+                             PRIMARY KEY (second, action, atomic, bucket));''',
             'DELETE FROM recs;',
-            'DELETE FROM info;']
+            'DELETE FROM info;',
+            'DELETE FROM rollup;',
+            'DELETE FROM reasons;',
+            'DELETE FROM arrivals;',
+            'DELETE FROM histograms;',
+            'DELETE FROM writers;']
     for sql in sqls:
         db_conn.execute(sql)
     db_conn.commit()
     return True
 
 
-def db_query(db_conn, sql):
+def db_query(db_conn, sql, params=()):
     cur = db_conn.cursor()
     try:
-        cur.execute(sql)
+        cur.execute(sql, params)
         db_conn.commit()
         return cur.lastrowid, cur.fetchall()
     except Exception as err:
@@ -121,40 +248,347 @@ def db_query(db_conn, sql):
         return 0, []
 
 
+def histogram_bucket(latency):
+    """Log-bucketed histogram: a bucket covers latencies growing by HISTOGRAM_GROWTH,
+    so there are a few hundred buckets at most whatever the number of requests.
+    """
+    if latency <= HISTOGRAM_MIN:
+        return 0
+    return int(math.log(latency / HISTOGRAM_MIN) / math.log(HISTOGRAM_GROWTH))
+
+
+def bucket_latency(bucket):
+    """Latency a bucket stands for: the geometric middle of the bucket."""
+    return HISTOGRAM_MIN * HISTOGRAM_GROWTH ** (bucket + 0.5)
+
+
+def percentile_field(percentile):
+    """Name of a chart field for a percentile: 'p50', 'p99_9'."""
+    return 'p%s' % str(percentile).replace('.', '_')
+
+
+def histogram_percentiles(histogram, percentiles=PERCENTILES, low=None, high=None):
+    """Calculate percentiles of latency (seconds) from a histogram {bucket: count}.
+    A bucket stands for its middle, so a percentile is clamped to the exact minimum (low)
+    and maximum (high) of the same latencies if they are known: p50 never exceeds the maximum.
+    """
+    total = sum(histogram.values())
+    result = {}
+    count = 0
+    buckets = iter(sorted(histogram))
+    for percentile in sorted(percentiles):
+        rank = max(1, math.ceil(total * percentile / 100.0))
+        while count < rank:
+            bucket = next(buckets)
+            count += histogram[bucket]
+        value = bucket_latency(bucket)
+        value = value if low is None else max(value, low)
+        result[percentile] = value if high is None else min(value, high)
+    return result
+
+
+def rollup_records(records):
+    """Aggregate records per (second, action, atomic, code) and per (code, reason).
+    Incomplete records (no latency) are counted but do not affect latency figures.
+    Corrected latency is measured from the intended start, so the time a request has been held
+    back by a stalled target or event loop is not omitted (coordinated omission).
+    Wait is the part of latency spent waiting for a pooled connection (for the concurrency cap
+    in case of transactions), so the rest of latency is spent waiting for the server.
+    """
+    rollup = {}
+    reasons = {}
+    histograms = {}  # latencies of completed requests per (second, action, atomic, bucket)
+    for atomic, timestamp, action, user, latency, code, reason, intended, wait, received, sent \
+            in records:
+        key = (int(float(timestamp)), action, atomic, code)
+        if key not in rollup:
+            # count, latency sum, min and max, corrected latency sum and max, wait sum, bytes
+            rollup[key] = [0, 0.0, None, None, 0.0, None, 0.0, 0, 0]
+        item = rollup[key]
+        item[0] += 1
+        item[7] += received
+        item[8] += sent
+        if latency is not None:
+            corrected = latency + max(0.0, timestamp - intended)
+            item[1] += latency
+            item[2] = latency if item[2] is None else min(item[2], latency)
+            item[3] = latency if item[3] is None else max(item[3], latency)
+            item[4] += corrected
+            item[5] = corrected if item[5] is None else max(item[5], corrected)
+            item[6] += wait
+            bucket = key[:3] + (histogram_bucket(latency),)
+            histograms[bucket] = histograms.get(bucket, 0) + 1
+        reasons[(code, reason)] = reasons.get((code, reason), 0) + 1
+    return rollup, reasons, histograms
+
+
+def db_update_rollup(db_conn, rollup, reasons):
+    """Merge aggregated records into rollup and reasons tables, the caller commits.
+    UPDATE-then-INSERT is used because code is NULL for incomplete requests.
+    """
+    cur = db_conn.cursor()
+    for key, (count, total, low, high, corrected, worst, wait, received, sent) in rollup.items():
+        cur.execute('UPDATE rollup SET count = count + ?, latency_sum = latency_sum + ?, '
+                    'latency_min = COALESCE(MIN(latency_min, ?), latency_min, ?), '
+                    'latency_max = COALESCE(MAX(latency_max, ?), latency_max, ?), '
+                    'corrected_sum = corrected_sum + ?, '
+                    'corrected_max = COALESCE(MAX(corrected_max, ?), corrected_max, ?), '
+                    'wait_sum = wait_sum + ?, bytes_in = bytes_in + ?, bytes_out = bytes_out + ? '
+                    'WHERE second = ? AND action = ? AND atomic = ? AND code IS ?',
+                    (count, total, low, low, high, high, corrected, worst, worst, wait,
+                     received, sent) + key)
+        if not cur.rowcount:
+            cur.execute('INSERT INTO rollup (second, action, atomic, code, count, latency_sum, '
+                        'latency_min, latency_max, corrected_sum, corrected_max, wait_sum, '
+                        'bytes_in, bytes_out) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        key + (count, total, low, high, corrected, worst, wait, received, sent))
+    for (code, reason), count in reasons.items():
+        cur.execute('UPDATE reasons SET count = count + ? WHERE code IS ? AND reason IS ?',
+                    (count, code, reason))
+        if not cur.rowcount:
+            cur.execute('INSERT INTO reasons (code, reason, count) VALUES (?, ?, ?)',
+                        (code, reason, count))
+
+
+def db_update_histograms(db_conn, histograms):
+    """Merge aggregated histograms into histograms table, the caller commits."""
+    cur = db_conn.cursor()
+    for key, count in histograms.items():
+        cur.execute('UPDATE histograms SET count = count + ? '
+                    'WHERE second = ? AND action = ? AND atomic = ? AND bucket = ?', (count,) + key)
+        if not cur.rowcount:
+            cur.execute('INSERT INTO histograms (second, action, atomic, bucket, count) '
+                        'VALUES (?, ?, ?, ?, ?)', key + (count,))
+
+
+def rollup_arrivals(arrivals):
+    """Aggregate arrivals of the open model per (second, action): started and dropped iterations,
+    sum and maximum of scheduler lag (how late an iteration has been started or dropped).
+    """
+    rollup = {}
+    for timestamp, action, lag, dropped in arrivals:
+        key = (int(timestamp), action)
+        if key not in rollup:
+            rollup[key] = [0, 0, 0.0, 0.0]
+        item = rollup[key]
+        item[1 if dropped else 0] += 1
+        item[2] += lag
+        item[3] = max(item[3], lag)
+    return rollup
+
+
+def db_update_arrivals(db_conn, rollup):
+    """Merge aggregated arrivals into arrivals table, the caller commits."""
+    cur = db_conn.cursor()
+    for key, (started, dropped, total, high) in rollup.items():
+        cur.execute('UPDATE arrivals SET started = started + ?, dropped = dropped + ?, '
+                    'lag_sum = lag_sum + ?, lag_max = MAX(lag_max, ?) '
+                    'WHERE second = ? AND action = ?', (started, dropped, total, high) + key)
+        if not cur.rowcount:
+            cur.execute('INSERT INTO arrivals (second, action, started, dropped, lag_sum, lag_max) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', key + (started, dropped, total, high))
+
+
 def log_sql(func):  # to be applied only to act() methods of classes inherited from Action()
     async def wrapper(*args):
-        timestamp = get_timestamp()
-        sql = "INSERT INTO recs (atomic, timestamp, action, user) VALUES (0, '%s', '%s', '%s')" \
-              % (timestamp, args[0].action, args[0].user)
-        row_id = db_query(args[0].conn, sql)[0]  # args[0] is an instance of Action
-        code, reason = await func(*args)
-        sql = "UPDATE recs SET latency='%s', code=%d, reason='%s' WHERE id=%s" \
-              % (get_timestamp() - timestamp, code, reason, row_id)
-        db_query(args[0].conn, sql)
-        return code, reason
+        # args[0] is an instance of Action
+        with LogSQL(args[0].recorder, args[0].action, args[0].user, atomic=0,
+                    intended=args[0].intended) as sql:
+            sql.wait = args[0].wait
+            try:
+                sql.code, sql.reason = await func(*args)
+            except Exception as err:  # a failed iteration, see AsyncLoad.act()
+                args[0].error = err
+                sql.code, sql.reason = CODES['ActionError'], error_reason(err)
+        return sql.code, sql.reason
     return wrapper
 
 
+def error_reason(err):
+    return '%s: %s' % (type(err).__name__, err)
+
+
+class Recorder(object):
+    """A class to keep records of requests in memory and write them into the database in bulk.
+    Records are flushed by a background thread (one transaction per flush)
+    once max_size records are buffered or every interval seconds, whichever comes first.
+    Per-second rollup is updated in the same transaction, so monitoring does not scan raw records.
+    Rollup buckets are keyed by the second a request has started at but written once it completes,
+    so each flush also stores in writers table the earliest second this process may still write:
+    the start of the oldest request in flight or the next arrival of the open model.
+    Buckets before it are final, monitoring sends buckets from there on (see monitor.py).
+    A flush which fails is retried, a batch is dropped only after FLUSH_ATTEMPTS failures,
+    dropped records are counted in reasons table under DROPPED_REASON, so the summary shows them.
+    """
+    def __init__(self, file_name, folder=None, max_size=1000, interval=1.0):
+        self.file_name = file_name
+        self.folder = folder
+        self.max_size = max_size
+        self.interval = interval
+        self.records = []       # completed requests waiting to be written into the database
+        self.arrivals = []      # arrivals scheduled by the open model, see CrowdLoad.arrive()
+        self.in_flight = set()  # LogSQL instances of requests which are not completed yet
+        self.scheduled = None   # the moment of the next arrival of the open model, see CrowdLoad.arrive()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.stats = {'records': 0, 'record_time': 0.0, 'flush_time': 0.0, 'flushes': 0, 'dropped': 0}
+        self.dropped_saved = 0  # dropped records already counted in the database
+        db_conn = get_db_conn(file_name, folder)
+        db_query(db_conn, 'INSERT OR REPLACE INTO writers (pid, open_from) VALUES (?, ?)',
+                 (os.getpid(), int(get_timestamp())))
+        db_conn.close()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def record(self, atomic, timestamp, action, user, latency=None, code=None, reason=None,
+               intended=None, wait=0.0, bytes_in=0, bytes_out=0):
+        """Buffer one request, the call is cheap and does not touch the database.
+        timestamp is when the request has been sent, intended - when it should have been sent,
+        wait - how long it has waited for a connection (for the concurrency cap if not atomic),
+        bytes_in and bytes_out - bytes received and sent, headers included.
+        """
+        began = time.perf_counter()
+        intended = timestamp if intended is None else intended
+        with self.lock:
+            self.records.append((atomic, timestamp, action, user, latency, code, reason,
+                                 intended, wait, bytes_in, bytes_out))
+            size = len(self.records)
+        if size >= self.max_size:
+            self.wakeup.set()
+        self.stats['record_time'] += time.perf_counter() - began
+
+    def record_arrival(self, timestamp, action, lag, dropped=False):
+        """Buffer one arrival of the open model: its intended moment, lag and whether it is dropped."""
+        with self.lock:
+            self.arrivals.append((timestamp, action, lag, dropped))
+
+    def writer(self):
+        """Flush buffered records in a loop, runs in a background thread with its own connection."""
+        db_conn = get_db_conn(self.file_name, self.folder, DB_BUSY_TIMEOUT)
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush(db_conn)
+        self.flush(db_conn)
+        db_query(db_conn, 'UPDATE writers SET open_from = NULL WHERE pid = ?', (os.getpid(),))
+        db_conn.close()
+
+    def open_from(self):
+        """The earliest second a record not taken by a flush yet can belong to. Called before
+        buffers are taken: a request leaves in_flight once recorded, so it is either in flight now
+        or in the buffers, and arrivals come in the order of their moments.
+        """
+        moments = [sql.timestamp for sql in tuple(self.in_flight)]  # one step under the GIL
+        scheduled = self.scheduled
+        return int(min(moments + [get_timestamp() if scheduled is None else scheduled]))
+
+    def flush(self, db_conn):
+        open_from = self.open_from()
+        with self.lock:
+            records, self.records = self.records, []
+            arrivals, self.arrivals = self.arrivals, []
+        if not records and not arrivals and self.dropped_saved == self.stats['dropped']:
+            db_query(db_conn, 'UPDATE writers SET open_from = ? WHERE pid = ?',
+                     (open_from, os.getpid()))
+            return 0
+        began = time.perf_counter()
+        rollup, reasons, histograms = rollup_records(records)
+        arrivals = rollup_arrivals(arrivals)
+        for attempt in range(1, FLUSH_ATTEMPTS + 1):
+            try:
+                self.write(db_conn, records, rollup, reasons, histograms, arrivals, open_from)
+                break
+            except sqlite3.Error as err:
+                print('%s ERROR DB: %s records not written (attempt %s of %s): %s' %
+                      (log_timestamp_str(), len(records), attempt, FLUSH_ATTEMPTS, err))
+                if attempt < FLUSH_ATTEMPTS:
+                    time.sleep(FLUSH_RETRY_DELAY * attempt)
+        else:
+            self.stats['dropped'] += len(records)
+            try:
+                self.write(db_conn, [], {}, {}, {}, {}, open_from)  # count them while we can
+            except sqlite3.Error as err:
+                print('%s ERROR DB: %s dropped records not counted yet: %s' %
+                      (log_timestamp_str(), self.stats['dropped'] - self.dropped_saved, err))
+        self.stats['flush_time'] += time.perf_counter() - began
+        self.stats['flushes'] += 1
+        self.stats['records'] += len(records)
+        return len(records)
+
+    def write(self, db_conn, records, rollup, reasons, histograms, arrivals, open_from):
+        """One transaction of a flush, dropped records not counted in the database yet are added
+        to reasons table; raises sqlite3.Error if the transaction is rolled back.
+        """
+        dropped = self.stats['dropped'] - self.dropped_saved
+        if dropped:
+            reasons = dict(reasons)
+            reasons[(None, DROPPED_REASON)] = reasons.get((None, DROPPED_REASON), 0) + dropped
+        sql = 'INSERT INTO recs (atomic, timestamp, action, user, latency, code, reason, ' + \
+              'intended, wait, bytes_in, bytes_out) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+        with db_conn:  # one transaction per flush
+            db_conn.executemany(sql, records)
+            db_update_rollup(db_conn, rollup, reasons)
+            db_update_histograms(db_conn, histograms)
+            db_update_arrivals(db_conn, arrivals)
+            db_conn.execute('UPDATE writers SET open_from = ? WHERE pid = ?', (open_from, os.getpid()))
+        self.dropped_saved += dropped
+
+    def close(self):
+        """Record requests still in flight as incomplete, make a final flush and stop the writer."""
+        for sql in list(self.in_flight):
+            self.record(sql.atomic, sql.timestamp, sql.action, sql.user, intended=sql.intended,
+                        wait=sql.wait)
+        self.in_flight.clear()
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        print('%s %s' % (log_timestamp_str(), self.describe_overhead()))
+
+    def overhead(self):
+        """Return recorder overhead per request in microseconds:
+        time spent on the event loop thread and time spent by the writer thread.
+        """
+        count = self.stats['records'] or 1
+        return {'records': self.stats['records'], 'flushes': self.stats['flushes'],
+                'dropped': self.stats['dropped'],
+                'loop_us': 1000000.0 * self.stats['record_time'] / count,
+                'writer_us': 1000000.0 * self.stats['flush_time'] / count}
+
+    def describe_overhead(self):
+        overhead = self.overhead()
+        return 'Recorder: %s records in %s flushes, %s dropped, %.2f us/request on event loop, ' \
+               '%.2f us/request in writer thread.' % (overhead['records'], overhead['flushes'],
+                                                      overhead['dropped'], overhead['loop_us'],
+                                                      overhead['writer_us'])
+
+
 class LogSQL(object):
-    """A class used for logging in atomic_get/atomic_post methods of Action-based classes."""
-    def __init__(self, conn, action, user):
-        self.conn = conn
+    """A class used for logging in atomic_get/atomic_post methods of Action-based classes.
+    Nothing is written on enter, a complete record is passed to the recorder on exit.
+    intended is the moment the request has been planned for (by the schedule or pacing),
+    it is the moment the request is actually sent if not given.
+    """
+    def __init__(self, recorder, action, user, atomic=1, intended=None):
+        self.recorder = recorder
         self.action = action
         self.user = user
-        self.row_id = None  # id of a row in the database (each request is kept in one row)
+        self.atomic = atomic
         self.code = None    # response code of the atomic HTTP request
         self.reason = None  # returned reason of the atomic HTTP request
         self.timestamp = get_timestamp()
+        self.intended = self.timestamp if intended is None else intended
+        self.wait = 0.0     # seconds waited for a pooled connection, see AsyncLoad.open_session()
+        self.bytes_in = 0   # bytes received and sent by the atomic HTTP request
+        self.bytes_out = 0
 
     def __enter__(self):
-        sql = "INSERT INTO recs (timestamp, action, user) VALUES ('%s', '%s', '%s')" \
-              % (self.timestamp, self.action, self.user)
-        self.row_id = db_query(self.conn, sql)[0]
+        self.recorder.in_flight.add(self)
         return self
 
     def __exit__(self, type, value, traceback):
-        sql = "UPDATE recs SET latency='%s', code=%d, reason='%s' WHERE id=%s" \
-              % (get_timestamp() - self.timestamp, self.code, self.reason, self.row_id)
-        db_query(self.conn, sql)
+        self.recorder.record(self.atomic, self.timestamp, self.action, self.user,
+                             get_timestamp() - self.timestamp, self.code, self.reason,
+                             self.intended, self.wait, self.bytes_in, self.bytes_out)
+        self.recorder.in_flight.discard(self)  # once recorded, see Recorder.open_from()
         return False
-
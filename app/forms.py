@@ -1,4 +1,4 @@
-from wtforms import validators, Form, FieldList, FormField, \
+from wtforms import validators, Form, FieldList, FormField, BooleanField, \
     SubmitField, StringField, PasswordField, IntegerField, SelectField, TextAreaField
 from wtforms.widgets import PasswordInput
 from . import db_queries, helpers, tools
@@ -28,6 +28,17 @@ class ServerForm(Form):
     web_port = IntegerField('Web port',
                             [validators.DataRequired(), validators.NumberRange(80, 9000)],
                             default=8081, render_kw={'size': 5, 'class': 'form-control form-control-sm'})
+    workers = IntegerField('Processes per action',
+                           [validators.NumberRange(0, 256)],
+                           description='0 - as many as CPU cores, shared between actions',
+                           default=0, render_kw={'size': 3, 'class': 'form-control form-control-sm'})
+    weight = IntegerField('Capacity weight',
+                          [validators.NumberRange(0, 1000)],
+                          description='load is split in proportion to weights, 0 - measured capacity',
+                          default=0, render_kw={'size': 3, 'class': 'form-control form-control-sm'})
+    calibrate = BooleanField('Calibrate',
+                             description='measure requests per second the slave can generate',
+                             default=False)
     clone = SubmitField('Clone', render_kw={'class': 'btn btn-primary btn-sm'})
     remove = SubmitField('Remove', render_kw={'class': 'btn btn-primary btn-sm'})
 
@@ -64,7 +75,7 @@ class ConfigForm(Form):
 
     def _packages_installed(self, ssh, host):
         modules = ['aiohttp', 'aiodns', 'asyncio', 'bottle', 'cchardet',
-                   'paramiko_expect', 'pathos', 'sqlite3', 'uvloop', 'yaml']
+                   'pathos', 'sqlite3', 'uvloop', 'yaml']
         missing = []
         for module in modules:
             cmd = '%s -c "import %s"' % (host['python3'], module)
@@ -100,6 +111,41 @@ class TestViewForm(Form):
                             render_kw={'cols': 100, 'rows': 10})
 
 
+class TestSettingsForm(Form):
+    """A class describing a form for settings of a test run applied to all steps."""
+    mode = SelectField('Load model:',
+                       choices=[('closed', 'Closed: virtual users act in a loop'),
+                                ('open', 'Open: iterations arrive at a rate')],
+                       default='closed', render_kw={'class': 'form-control form-control-sm'})
+    arrivals = SelectField('Arrivals (open model):',
+                           choices=[('uniform', 'Uniform'), ('poisson', 'Poisson')],
+                           default='uniform', render_kw={'class': 'form-control form-control-sm'})
+
+
+class ClientProfileForm(Form):
+    """A class describing a form for the HTTP client profile, applied to each slave process."""
+    limit = IntegerField('Connections in total:',
+                         [validators.NumberRange(0, 100000)],
+                         description='0 - no limit',
+                         default=100, render_kw={'class': 'form-control form-control-sm'})
+    limit_per_host = IntegerField('Connections per host:',
+                                  [validators.NumberRange(0, 100000)],
+                                  description='0 - no limit',
+                                  default=0, render_kw={'class': 'form-control form-control-sm'})
+    keepalive = IntegerField('Keep-alive (seconds):',
+                             [validators.NumberRange(0, 3600)],
+                             description='0 - close connections after each request',
+                             default=15, render_kw={'class': 'form-control form-control-sm'})
+    dns_cache = IntegerField('DNS cache (seconds):',
+                             [validators.NumberRange(0, 86400)],
+                             description='0 - resolve host names for each connection',
+                             default=10, render_kw={'class': 'form-control form-control-sm'})
+    concurrency = IntegerField('Concurrent iterations:',
+                               [validators.NumberRange(0, 100000)],
+                               description='0 - no limit, otherwise users wait for their turn',
+                               default=0, render_kw={'class': 'form-control form-control-sm'})
+
+
 class TestStepForm(Form):
     """A class describing a form for one test run step."""
     locals()['start'] = IntegerField('Start at second #:',
@@ -108,10 +154,14 @@ class TestStepForm(Form):
     locals()['duration'] = IntegerField('Duration (seconds):',
                             [validators.DataRequired(), validators.NumberRange(1, 600)],
                             default=1, render_kw={'class': 'form-control form-control-sm'})
+    locals()['ramp'] = SelectField('Change users:',
+                                   choices=[('step', 'At once'), ('linear', 'Linearly')],
+                                   default='step', render_kw={'class': 'form-control form-control-sm'})
     for action in tools.collect_actions():
         locals()[action] = IntegerField('%s:<br>delta users' % action,
                             [validators.DataRequired(), validators.NumberRange(-5000, 5000)],
-                            description='Use positive integers to add users, negative - to remove',
+                            description='Use positive integers to add users, negative - to remove. '
+                                        'In the open model deltas are iterations per second',
                             default=0, render_kw={'class': 'form-control form-control-sm'})
     clone = SubmitField('Clone', render_kw={'class': 'btn btn-primary btn-sm btn-block'})
     remove = SubmitField('Remove', render_kw={'class': 'btn btn-primary btn-sm btn-block'})
@@ -119,10 +169,13 @@ class TestStepForm(Form):
 
 class TestRunForm(Form):
     """A class describing a form for all steps of a test run."""
+    settings = FieldList(FormField(TestSettingsForm), min_entries=1, max_entries=1)
+    client = FieldList(FormField(ClientProfileForm), min_entries=1, max_entries=1)
     steps = FieldList(FormField(TestStepForm), min_entries=1, max_entries=5)
 
     def collect_load(self):
         intervals = []
+        ramps = [item['ramp'] for item in self.steps.data]
         actions = [item for item in list(self.steps.data[0].keys()) if item.startswith('Action')]
         deltas = {action: [] for action in actions}
         errors = []
@@ -146,6 +199,9 @@ class TestRunForm(Form):
                 users_action += item[action] if item[action] > 0 else 0
             users_count += users_action
             users[action][1] = users_count
+        settings = self.settings.data[0]
         result = {'errors': errors, 'users_count': users_count,
-                  'intervals': intervals, 'actions': deltas, 'users': users}
+                  'intervals': intervals, 'actions': deltas, 'users': users, 'ramps': ramps,
+                  'mode': settings['mode'], 'arrivals': settings['arrivals'],
+                  'client': self.client.data[0]}
         return result
\ No newline at end of file
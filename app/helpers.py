@@ -1,12 +1,30 @@
 import os
 import json
-import paramiko
-from threading import Thread
+import math
+import time
+import shutil
+import tempfile
+from threading import Thread, Lock
+from urllib.parse import urlencode, parse_qsl
 from multiprocessing.dummy import Pool as ThreadPool
 from queue import Queue
+from app import app
 from .engine import tools as etools  # engine tools
+from .engine import monitor as emonitor  # readers of test run data, for harvested test runs
 from .forms import ConfigForm
-from . import tools
+from . import tools, db_queries
+
+
+ARM_TIMEOUT = 30  # seconds for a slave to get armed, should be less than FIRE_TIMEOUT in slave.py
+FIRE_DELAY = 1    # seconds between the moment all slaves are armed and the moment they start at
+STREAM_PERIOD = 1  # seconds between events pushed to the monitoring page
+HARVEST_PAGE = 50000   # rows of a slave table per request to the monitoring agent
+HARVEST_TIMEOUT = 60   # seconds for a monitoring agent to return a page of rows
+HARVEST_PERIOD = 5     # seconds between checks if a test run is over, to harvest it
+HARVEST_WAIT = 3600    # seconds to keep checking after the test run should have ended
+REGRESSION_THRESHOLD = 10  # a metric worse than in the baseline test run by more is a regression
+SIGNIFICANCE_T = 2.0       # Welch's t of per-second samples above which a difference is significant
+CALIBRATION_SECONDS = 5    # seconds of load a slave generates to calibrate, see engine/calibrate.py
 
 
 def write_yaml_conf(form):
@@ -14,12 +32,16 @@ def write_yaml_conf(form):
     msg = ''
     hosts = []
     do_update = True
+    calibrations = {cnf['host']: cnf['calibration'] for cnf in etools.load_conf('conf.yaml')
+                    if cnf.get('calibration')}
     for item in form.hosts.data:
         if item['clone'] or item['remove']:
             do_update = False
             break
         else:
-            hosts.append({k: v for k, v in item.items() if k not in ['clone', 'remove']})
+            hosts.append({k: v for k, v in item.items() if k not in ['clone', 'remove', 'calibrate']})
+            if item['host'] in calibrations:  # measured once, kept until the slave is calibrated again
+                hosts[-1]['calibration'] = calibrations[item['host']]
     if do_update:
         etools.save_conf(hosts, 'conf.yaml')
         msg = 'Settings have been successfully written to conf.yaml.'
@@ -34,7 +56,7 @@ def load_yaml_conf(request_form):
         while form.hosts.data:
             form.hosts.pop_entry()  # remove default values defined in ConfigForm class
         for host in hosts:
-            host.update({'clone': False, 'remove': False})
+            host.update({'clone': False, 'remove': False, 'calibrate': False})
             form.hosts.append_entry(host)
         msg = 'Hosts settings have been successfully loaded from conf.yaml.'
     else:
@@ -94,44 +116,105 @@ def update_constructor_form(form):
     return form, msg
 
 def deploy_slaves(files):
-    """Deploy all slaves in parallel using multiple threads. TODO: decorator for threading."""
+    """Deploy all slaves in parallel using multiple threads. TODO: decorator for threading.
+    Files are read and hashed once, each slave gets only the files it does not have yet.
+    :return: a 2-tuple (messages about files sent, errors).
+    """
+    bundle, errors = tools.read_bundle(files)
+    if errors:
+        return [], errors
     queue = Queue()
     args = []
     for cnf in etools.load_conf('conf.yaml'):
-        args.append((cnf, files, queue))
+        args.append((cnf, bundle, queue))
     pool = ThreadPool(len(args))
     results = pool.starmap(deploy_slave, args)
     pool.close()
     pool.join()
     errors = tools.collect_threads_results(queue)
-    return errors
+    messages = ['%s: %s' % (cnf['host'], ', '.join(sent) if sent else 'up to date')
+                for (cnf, _, _), sent in zip(args, results)]
+    return messages, errors
+
 
-def deploy_slave(cnf, files, queue):
-    """Run OS commands on a slave host through SSH to create folders and start monitoring agent."""
-    with paramiko.SSHClient() as ssh:
-        errors = tools.ssh_connect_errors(ssh, cnf)
+def deploy_slave(cnf, bundle, queue):
+    """Run OS commands on a slave host through SSH to create folders, bring files up to date
+    and start monitoring agent.
+    :return: names of files sent.
+    """
+    sent = []
+    with tools.ssh_pool.session(cnf) as (ssh, errors):
         if errors:
-            return errors
+            for error in errors:
+                queue.put(error)
+            return sent
         error = tools.ssh_runcmd(ssh, 'mkdir -p %s' % cnf['folder'])[2].read().strip()
         if error:
-            return ['Could not create folders on %s: %s' % (cnf['host'], error.decode('utf-8'))]
-        errors = tools.ssh_transfer(ssh, cnf, files)
+            queue.put('Could not create folders on %s: %s' % (cnf['host'], error.decode('utf-8')))
+            return sent
+        sftp, errors = tools.ssh_pool.sftp(cnf)
+        if not errors:
+            sent, errors = tools.ssh_deploy_bundle(ssh, sftp, cnf, bundle)
         if not errors:
-            cmd = 'cd %s && nohup %s monitor.py --server=%s --port=%s > monitor.log && disown\n' % \
-                  (cnf['folder'], cnf['python3'], cnf['host'], cnf['web_port'])
-            errors = tools.ssh_interact(ssh, cnf, cmd, 'Started')
+            cmd = 'monitor.py --server=%s --port=%s' % (cnf['host'], cnf['web_port'])
+            errors = tools.ssh_launch(ssh, cnf, cmd, 'monitor.log') or \
+                tools.ssh_wait_agent(ssh, cnf, 'monitor.log')
     for error in errors:
         queue.put(error)
-    return errors
+    return sent
+
+
+def calibrate_slaves(hosts):
+    """Calibrate slaves in parallel: each one generates load against a local stub target,
+    results are stored in conf.yaml next to the host entries, see engine/calibrate.py.
+    :return: a 2-tuple (messages, errors).
+    """
+    if not hosts:
+        return [], []
+    queue = Queue()
+    conf = etools.load_conf('conf.yaml')
+    args = [(cnf, queue) for cnf in conf if cnf['host'] in hosts]
+    pool = ThreadPool(len(args))
+    results = pool.starmap(calibrate_slave, args)
+    pool.close()
+    pool.join()
+    messages = []
+    for (cnf, _), result in zip(args, results):
+        if result:
+            cnf['calibration'] = result
+            messages.append('%s: %s requests per second (%s per process), %.3f ms of CPU '
+                            'per request' % (cnf['host'], result['capacity'], result['rps'],
+                                             result['cpu_ms']))
+    etools.save_conf(conf, 'conf.yaml')
+    return messages, tools.collect_threads_results(queue)
+
+
+def calibrate_slave(cnf, queue):
+    """Run the calibration on a slave through SSH and wait for its result.
+    :return: a dictionary of calibration results or None.
+    """
+    with tools.ssh_pool.session(cnf) as (ssh, errors):
+        if not errors:
+            output, errors = tools.ssh_python(ssh, cnf, 'import calibrate; calibrate.main()',
+                                              ['--seconds', str(CALIBRATION_SECONDS)])
+        if not errors:
+            try:
+                return json.loads(output.strip().split('\n')[-1])
+            except ValueError:
+                errors = ['Could not calibrate slave %s: %s' % (cnf['host'], output.strip())]
+    for error in errors:
+        queue.put(error)
+    return None
 
 
 def validate_slaves(form):
     """Validate all slaves in parallel using multiple threads. TODO: decorator for threading."""
     queue = Queue()
-    for host in form.hosts.data:
-        thread = Thread(target=validate_slave, args=(form, host, queue))
-        thread.start()
-        thread.join()
+    args = [(form, host, queue) for host in form.hosts.data]
+    pool = ThreadPool(len(args))
+    pool.starmap(validate_slave, args)
+    pool.close()
+    pool.join()
     errors = tools.collect_threads_results(queue)
     return errors
 
@@ -143,8 +226,8 @@ def validate_slave(form, cnf, queue):
     - required Python packages,
     - availability of the port for monitoring agent.
     """
-    with paramiko.SSHClient() as ssh:
-        if tools.ssh_connect_errors(ssh, cnf):
+    with tools.ssh_pool.session(cnf) as (ssh, errors):
+        if errors:
             queue.put('Cannot SSH onto %s.' % cnf['host'])
         else:
             host_errors = []
@@ -161,16 +244,23 @@ def validate_slave(form, cnf, queue):
 
 
 def start_slaves(obj):
-    """Start all slaves in parallel using multiple threads. TODO: decorator for threading."""
+    """Start a test run on all slaves in two phases. TODO: decorator for threading.
+    Arm: in parallel, each slave gets the load, spawns processes, makes plans and opens sessions.
+    Fire: once all slaves are armed, all of them are told to start at the same moment,
+    otherwise all of them are told to abort.
+    """
     fname = 'load-%s.json' % obj.test_run_id
     abs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
     with open(abs_path, 'w') as _f:
         _f.write(json.dumps(obj.part, sort_keys=True, indent=4))
+    confs = etools.load_conf('conf.yaml')
     queue = Queue()
     args = []
-    for cnf in etools.load_conf('conf.yaml'):
+    for cnf in confs:
         cmd = 'slave.py -n=%s -t=%s -f=%s/%s' % (cnf['host'], obj.test_run_id, cnf['folder'], fname)
-        args.append((cnf, obj.test_run_id, cmd, queue))
+        ranges = list(obj.part[cnf['host']]['users'].values())  # contiguous for a slave
+        users = (min([item[0] for item in ranges]), max([item[1] for item in ranges]))
+        args.append((cnf, obj.test_run_id, cmd, users, queue))
     pool = ThreadPool(len(args))
     results = pool.starmap(start_slave, args)
     pool.close()
@@ -178,22 +268,47 @@ def start_slaves(obj):
     errors = tools.collect_threads_results(queue)
     if os.path.isfile(abs_path):
         os.remove(abs_path)
+    fire_at = etools.get_timestamp() + FIRE_DELAY if not errors else 0
+    args = [(cnf, obj.test_run_id, fire_at, queue) for cnf in confs]
+    pool = ThreadPool(len(args))
+    pool.starmap(fire_slave, args)
+    pool.close()
+    pool.join()
+    errors.extend(tools.collect_threads_results(queue))
     return errors
 
 
-def start_slave(cnf, test_run_id, command, queue):
-    """Run OS commands on a slave host through SSH to start a test run."""
-    with paramiko.SSHClient() as ssh:
-        errors = tools.ssh_connect_errors(ssh, cnf)
-        if errors:
-            return errors
-        load_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                  'load-%s.json' % test_run_id)
-        errors = tools.ssh_transfer(ssh, cnf, [load_fname])
+def start_slave(cnf, test_run_id, command, users, queue):
+    """Run OS commands on a slave host through SSH to start a test run and wait until it is armed.
+    The slave gets the load and the slice of the index of users in the range of its users.
+    Every error, the failed SSH connection included, is queued: then no slave is fired.
+    """
+    with tools.ssh_pool.session(cnf) as (ssh, errors):
         if not errors:
-            cmd = 'cd %s && nohup %s %s > %s-testrun.log && disown' % \
-                   (cnf['folder'], cnf['python3'], command, test_run_id)
-            errors = tools.ssh_interact(ssh, cnf, cmd, 'Started')
+            load_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'load-%s.json' % test_run_id)
+            folder = tempfile.mkdtemp()
+            users_fname = os.path.join(folder, 'users-%s.idx' % test_run_id)
+            etools.slice_user_index(users[0], users[1], users_fname)
+            sftp, errors = tools.ssh_pool.sftp(cnf)
+            errors = errors or tools.ssh_transfer(sftp, cnf, [load_fname, users_fname])
+            shutil.rmtree(folder)
+        if not errors:
+            errors = tools.ssh_launch(ssh, cnf, command, '%s-testrun.log' % test_run_id)
+        if not errors:
+            errors = tools.ssh_wait_file(sftp, cnf, '%s.armed' % test_run_id, ARM_TIMEOUT)
+            if errors:
+                errors = ['%s %s' % (errors[0], tools.ssh_log_tail(ssh, cnf,
+                                                                   '%s-testrun.log' % test_run_id))]
+    for error in errors:
+        queue.put(error)
+    return errors
+
+
+def fire_slave(cnf, test_run_id, fire_at, queue):
+    """Tell an armed slave the moment to start the test run at, 0 means the test run is aborted."""
+    sftp, errors = tools.ssh_pool.sftp(cnf)
+    errors = errors or tools.ssh_write(sftp, cnf, '%s.fire' % test_run_id, str(fire_at))
     for error in errors:
         queue.put(error)
     return errors
@@ -202,11 +317,11 @@ def start_slave(cnf, test_run_id, command, queue):
 def delete_testrun(test_run_title):
     """Delete test run files from slaves in parallel using multiple threads. TODO: decorator."""
     queue = Queue()
-    for cnf in etools.load_conf('conf.yaml'):
-        thread = Thread(target=delete_testrun_from_slave,
-                        args=(cnf, cnf['folder'], test_run_title, queue))
-        thread.start()
-        thread.join()
+    args = [(cnf, cnf['folder'], test_run_title, queue) for cnf in etools.load_conf('conf.yaml')]
+    pool = ThreadPool(len(args))
+    pool.starmap(delete_testrun_from_slave, args)
+    pool.close()
+    pool.join()
     errors = tools.collect_threads_results(queue)
     if errors:
         return [(err, 'danger') for err in errors]
@@ -215,11 +330,13 @@ def delete_testrun(test_run_title):
 
 def delete_testrun_from_slave(cnf, folder, test_run, queue):
     """Run OS commands on a slave host through SSH to delete db- and json-files of the test run."""
-    with paramiko.SSHClient() as ssh:
-        if tools.ssh_connect_errors(ssh, cnf):
+    with tools.ssh_pool.session(cnf) as (ssh, errors):
+        if errors:
             queue.put('Could not SSH onto slave %s.' % cnf['host'])
             return False
-        files = ['%s/%s.db' % (folder, test_run), '%s/load-%s.json' % (folder, test_run)]
+        files = ['%s/%s.db' % (folder, test_run), '%s/load-%s.json' % (folder, test_run),
+                 '%s/users-%s.idx' % (folder, test_run),
+                 '%s/%s.armed' % (folder, test_run), '%s/%s.fire' % (folder, test_run)]
         tools.ssh_runcmd(ssh, 'rm -f %s' % ' '.join(files))
         out = tools.ssh_runcmd(ssh, 'ls -l %s' % folder)[1].read().decode('utf-8')
         for fname in files:
@@ -228,67 +345,323 @@ def delete_testrun_from_slave(cnf, folder, test_run, queue):
     return True
 
 
-def monitor_slaves(url):
-    """Collect monitoring data from slaves in parallel using multiple threads. TODO: decorator."""
-    url_right = url[url.rfind('/'):]
-    queue = Queue()
-    for cnf in etools.load_conf('conf.yaml'):
-        url_left = 'http://%s:%s' % (cnf['host'], cnf['web_port'])
-        thread = Thread(target=monitor_slave, args=(url_left + url_right, queue))
-        thread.start()
-        thread.join()
-    data = tools.collect_threads_results(queue)
+def monitor_slaves(url, test_run_title=None):
+    """Collect monitoring data from all slaves concurrently, each slave has its own deadline.
+    Slaves which have not responded in time are reported as unreachable.
+    Chart data and summary of a harvested test run are read from the master database instead.
+    """
+    harvested = db_queries.harvested_slaves(test_run_title) \
+        if test_run_title and '_get_logs' not in url else []
+    if harvested:
+        data, unreachable, hosts = read_harvested_data(url, test_run_title, harvested), {}, {}
+    else:
+        data, unreachable, hosts = fetch_slaves_data(url)
     if '_get_summary' in url:
         data = aggregate_summary(data)
     elif '_get_chartdata' in url:
         data = aggregate_chartdata(data)
+        data['unreachable'] = {hosts[host]: error for host, error in unreachable.items()}
+        if unreachable and data['status'] == 'FINISHED':  # cannot tell for unreachable slaves
+            data['status'] = 'IN PROGRESS'
     else:
         data = aggregate_logs(data)
+        data.extend([{'host': host, 'logs': {'monitor': 'Unreachable: %s' % error, 'testrun': ''}}
+                     for host, error in sorted(unreachable.items())])
+    return data
+
+
+def fetch_slaves_data(url):
+    """Query monitoring agents of all slaves.
+    :return: decoded data, errors of unreachable agents and slave hosts by agent address.
+    """
+    url_right = url[url.rfind('/'):].replace('/_get_', '/v%s/' % etools.PROTOCOL, 1)
+    hosts = {'%s:%s' % (cnf['host'], cnf['web_port']): cnf['host']
+             for cnf in etools.load_conf('conf.yaml')}
+    responses = tools.agents_client().get_all({host: 'http://%s%s' % (host, url_right)
+                                               for host in hosts})
+    data = []
+    unreachable = {}
+    for host, (body, error) in sorted(responses.items()):
+        if not error:
+            try:
+                data.append(decode_slave_data(url, body))
+            except ValueError as err:
+                error = 'Could not parse response: %s' % err
+        if error:
+            unreachable[host] = error
+    return data, unreachable, hosts
+
+
+def read_harvested_data(url, test_run_title, slaves):
+    """Read data of a harvested test run the way monitoring agents read it on slaves."""
+    args = dict(parse_qsl(url[url.find('?') + 1:]))
+    trid = db_queries.get_test_run_by_title(test_run_title).id
+    data = []
+    for slave in slaves:
+        db_conn = db_queries.results_conn(trid, slave)
+        if '_get_chartdata' in url:
+            results, result = emonitor.collect_chartdata(db_conn, int(args.get('since') or 0),
+                                                         args.get('y_axis').strip(),
+                                                         args.get('actions').strip().split(','))
+            result['total'] = {item.pop('timestamp'): item for item in results}
+        else:
+            result = {item['reason']: {'code': item['code'], 'count': item['count']}
+                      for item in emonitor.collect_summary(db_conn)}
+        db_conn.close()
+        data.append(result)
     return data
 
 
-def monitor_slave(url, queue):
-    """Send HTTP GET request to a slave host to collect test run data."""
-    response = tools.http_get(url)
-    body = str(response.read()).replace("'", '"')
-    body = body[body.find('(') + 1:body.rfind(')')]
-    result = json.loads(body)
+def harvest_testrun(test_run_title):
+    """Copy results of a test run which is over from all slaves into the master database.
+    Slaves send pages of rows in parallel, the pages are written by this thread only
+    as SQLite takes one writer at a time; a slave is harvested anew if it has failed before.
+    :return: errors.
+    """
+    test_run = db_queries.get_test_run_by_title(test_run_title)
+    done = {harvest.slave for harvest in db_queries.get_harvests(test_run.id) if not harvest.error}
+    confs = [cnf for cnf in etools.load_conf('conf.yaml') if cnf['host'] not in done]
+    if not confs:
+        return []
+    for cnf in confs:
+        db_queries.clear_results(test_run.id, cnf['host'])
+    queue = Queue(maxsize=len(confs) * 2)
+    pool = ThreadPool(len(confs))
+    pool.starmap_async(harvest_slave, [(cnf, test_run_title, queue) for cnf in confs])
+    pool.close()
+    rows = {cnf['host']: 0 for cnf in confs}
+    errors = []
+    finished = 0
+    while finished < len(confs):
+        slave, table, columns, error = queue.get()
+        if table is not None:
+            rows[slave] += db_queries.save_results(test_run.id, slave, table, columns)
+            continue
+        finished += 1
+        if error:
+            db_queries.clear_results(test_run.id, slave)
+            errors.append('Could not harvest test run %s from slave %s: %s'
+                          % (test_run_title, slave, error))
+        db_queries.save_harvest(test_run.id, slave, rows[slave], error)
+    pool.join()
+    return errors
+
+
+def harvest_slave(cnf, test_run_title, queue):
+    """Fetch all the tables of a test run from a slave page by page and put the pages in a queue,
+    a page is (slave, table, columns, None), the last item is (slave, None, None, error).
+    """
+    host = '%s:%s' % (cnf['host'], cnf['web_port'])
+    error = ''
+    try:
+        for table in etools.HARVEST_TABLES:
+            after = 0
+            while True:
+                url = 'http://%s/v%s/harvest?%s' % (host, etools.PROTOCOL, urlencode(
+                    {'test_run_id': test_run_title, 'table': table,
+                     'after': after, 'limit': HARVEST_PAGE}))
+                body, error = tools.agents_client().get_all({host: url}, HARVEST_TIMEOUT)[host]
+                if error:
+                    return
+                result = decode_slave_data(url, body)
+                queue.put((cnf['host'], table, result['columns'], None))
+                if result['count'] < HARVEST_PAGE:
+                    break
+                after = result['cursor']
+    except (ValueError, KeyError) as err:
+        error = 'Could not parse response: %s' % err
+    finally:
+        queue.put((cnf['host'], None, None, error or ''))
+
+
+_harvesting = set()  # titles of test runs being harvested or waited for
+_harvesting_lock = Lock()
+
+
+def harvest_later(test_run_title, delay=0):
+    """Harvest a test run in background once it is over on all slaves, nothing to do
+    if it is being harvested already: a test run is harvested when the monitoring page
+    finds it is over, or by the thread started with the test run if nobody is watching.
+    """
+    with _harvesting_lock:
+        if test_run_title in _harvesting:
+            return
+        _harvesting.add(test_run_title)
+    Thread(target=wait_and_harvest, args=(test_run_title, delay), daemon=True).start()
+
+
+def wait_and_harvest(test_run_title, delay):
+    try:
+        with app.app_context():
+            if db_queries.harvested_slaves(test_run_title):
+                return
+            time.sleep(delay)
+            url = '/_get_chartdata?%s' % urlencode({'test_run_id': test_run_title,
+                                                    'y_axis': 'sched', 'actions': '',
+                                                    'slave': 'total', 'since': 0})
+            deadline = time.time() + HARVEST_WAIT
+            while monitor_slaves(url)['status'] not in ['FINISHED', 'ABORTED', 'CANCELLED']:
+                if time.time() > deadline:
+                    return
+                time.sleep(HARVEST_PERIOD)
+            for error in harvest_testrun(test_run_title):
+                print(error)
+    finally:
+        with _harvesting_lock:
+            _harvesting.discard(test_run_title)
+
+
+def monitor_snapshot(endpoint, args, ttl=None):
+    """Collect aggregated monitoring data, shared between viewers asking for the same data
+    (the JSONP callback does not matter), see tools.SnapshotCache.
+    Chart buckets of all viewers are kept together whatever their 'since' cursors are,
+    a viewer gets the buckets from its 'since' second, see refresh_chartdata().
+    """
+    args = {name: value for name, value in args.items() if name not in ['callback', '_']}
+    since = int(args.pop('since', 0) or 0) if endpoint == '/_get_chartdata' else None
+    key = (endpoint, tuple(sorted((name, str(value)) for name, value in args.items())))
+    if since is None:
+        return tools.snapshot_cache.get(key, monitor_slaves, '%s?%s' % (endpoint, urlencode(args)),
+                                        args.get('test_run_id'), ttl=ttl)
+    chart = tools.snapshot_cache.get(key, refresh_chartdata, key, args, ttl=ttl)
+    return dict(chart, total=[item for item in chart['total'] if int(item['timestamp']) >= since])
+
+
+def refresh_chartdata(key, args):
+    """Update the last snapshot of chart data: slaves are asked for buckets from its cursor only,
+    buckets before the cursor are final and kept. The cursor stays while any slave is unreachable,
+    as buckets are not complete without it.
+    """
+    last = tools.snapshot_cache.last(key)
+    since = last['cursor'] if last else 0
+    data = monitor_slaves('/_get_chartdata?%s' % urlencode(dict(args, since=since)),
+                          args.get('test_run_id'))
+    if last:
+        data['total'] = [item for item in last['total'] if int(item['timestamp']) < since] + \
+            data['total']
+    if data.get('unreachable'):
+        data['cursor'] = since
+    return data
+
+
+def stream_testrun(test_run_id, y_axis, actions, since=0):
+    """Generate Server-Sent Events for the monitoring page, one event per STREAM_PERIOD:
+    chart buckets from 'since' second, status and progress, summary of responses if changed.
+    The stream ends with 'end' event once the test run is over on all slaves.
+    """
+    summary = None
+    while True:
+        began = time.monotonic()
+        chart = monitor_snapshot('/_get_chartdata', {'test_run_id': test_run_id, 'y_axis': y_axis,
+                                                     'actions': actions, 'slave': 'total',
+                                                     'since': since}, STREAM_PERIOD)
+        event = {'since': since, 'chart': chart}
+        current = monitor_snapshot('/_get_summary', {'test_run_id': test_run_id, 'slave': 'total'},
+                                   STREAM_PERIOD)
+        if current != summary:
+            event['summary'] = summary = current
+        yield 'data: %s\n\n' % json.dumps(event)
+        if chart['status'] in ['FINISHED', 'ABORTED', 'CANCELLED']:
+            yield 'event: end\ndata: {}\n\n'
+            return
+        since = chart['cursor']
+        time.sleep(max(0, STREAM_PERIOD - (time.monotonic() - began)))
+
+
+def decode_slave_data(url, body):
+    """Decode a response of a machine endpoint of a monitoring agent, see columns() in monitor.py:
+    the agent sends arrays of values, the master aggregates items keyed by the timestamp
+    (chart data), by the reason (summary) or a single item (logs).
+    The body is decompressed by the client already as the agent sends it gzip-encoded.
+    """
+    result = json.loads(body.decode('utf-8'))
+    if result.pop('version', None) != etools.PROTOCOL:
+        raise ValueError('the agent does not speak protocol version %s, update it' % etools.PROTOCOL)
     if '_get_chartdata' in url:
-        total = {item['timestamp']: {'failed': item['failed'],
-                                     'passed': item['passed'],
-                                     'incomplete': item['incomplete']}
-                for item in result['total']}
+        columns = result.pop('columns')
+        weights = columns.pop('weights', {})
+        histograms = columns.pop('histogram', None)
+        lows = columns.pop('low', None)
+        total = {}
+        for i, timestamp in enumerate(columns.pop('timestamp')):
+            item = {field: values[i] for field, values in columns.items()}
+            if weights:
+                item['weights'] = {field: values[i] for field, values in weights.items()}
+            if histograms is not None:
+                item['histogram'] = histograms[i]
+            if lows is not None:
+                item['low'] = lows[i]
+            total[str(timestamp)] = item
         result['total'] = total
     elif '_get_summary' in url:
-        result = {item['reason']: {'code': item['code'], 'count': item['count']} for item in result}
-    else:  # '_get_logs'
-        result = result[0]
-    queue.put(result)
-    return response
+        columns = result['columns']
+        result = {reason: {'code': code, 'count': count}
+                  for reason, code, count in zip(columns['reason'], columns['code'],
+                                                 columns['count'])}
+    return result
 
 
 def aggregate_chartdata(data):
-    """Aggregate test run data collected from all slaves to draw an aggregated chart."""
+    """Aggregate test run data collected from all slaves to draw an aggregated chart.
+    Slaves return buckets starting from the same 'since' second, so the aggregated buckets
+    are complete; the cursor for the next poll is the smallest one reported by slaves.
+    Fields are summed up between slaves unless the agent asks to merge them otherwise:
+    'max' - the maximum, 'mean' - the average weighted by 'weights' of the bucket,
+    'histogram' - a percentile calculated from latency histograms merged between slaves,
+    bounded by the minimum ('low') and the maximum ('max') of the bucket among slaves.
+    """
     status = 'FINISHED'
     progress = 604801  # 1 week seconds + 1
+    cursor = None
     started = 'not defined'
     finished = '(not completed)'
+    offsets = {}
+    fields = data[0]['fields'] if data else []
+    merge = data[0]['merge'] if data else {}
     total = {}
+    weights = {}
+    histograms = {}
+    lows = {}
     for item in data:
         for key, value in item['total'].items():
             if key not in total:
-                total.update({key: {'failed': 0, 'passed': 0, 'incomplete': 0}})
-            total[key]['failed'] += value['failed']
-            total[key]['passed'] += value['passed']
-            total[key]['incomplete'] += value['incomplete']
-        status = 'IN PROGRESS' if item['status'] == 'IN PROGRESS' else status
+                total.update({key: {field: 0 for field in fields}})
+                weights.update({key: {field: 0 for field in fields}})
+                histograms.update({key: {}})
+            for bucket, count in value.get('histogram', []):
+                histograms[key][bucket] = histograms[key].get(bucket, 0) + count
+            if value.get('histogram') and 'low' in value:
+                lows[key] = min(lows.get(key, value['low']), value['low'])
+            for field in fields:
+                if merge.get(field) == 'max':
+                    total[key][field] = max(total[key][field], value[field])
+                elif merge.get(field) == 'mean':
+                    total[key][field] += value[field] * value['weights'][field]
+                    weights[key][field] += value['weights'][field]
+                else:
+                    total[key][field] += value[field]
+        if item['status'] in ['ARMING', 'ARMED', 'IN PROGRESS']:
+            status = 'IN PROGRESS'
+        elif item['status'] == 'ABORTED' and status == 'FINISHED':
+            status = 'ABORTED'
+        offsets.update(item['offsets'])
         started = item['started'] if item['started'] < started else started
         finished = item['finished'] if item['finished'] > finished else finished
         progress = item['progress'] if item['progress'] < progress else progress
-    total = [{'timestamp': key, 'failed': total[key]['failed'], 'passed': total[key]['passed'],
-              'incomplete': total[key]['incomplete']}
-             for key in sorted(total, key=lambda key: int(key))]
-    result = {'total': total,
+        cursor = item['cursor'] if cursor is None or item['cursor'] < cursor else cursor
+    percentiles = {etools.percentile_field(percentile): percentile
+                   for percentile in etools.PERCENTILES}
+    for key, value in total.items():
+        for field in [field for field in fields if merge.get(field) == 'mean']:
+            value[field] = value[field] / weights[key][field] if weights[key][field] else 0
+        if histograms[key]:
+            low = lows[key] / 1000.0 if key in lows else None
+            high = value['max'] / 1000.0 if 'max' in value else None
+            merged = etools.histogram_percentiles(histograms[key], low=low, high=high)
+            for field in [field for field in fields if merge.get(field) == 'histogram']:
+                value[field] = round(merged[percentiles[field]] * 1000, 3)
+    total = [dict(timestamp=key, **total[key]) for key in sorted(total, key=lambda key: int(key))]
+    result = {'total': total, 'fields': fields, 'cursor': cursor or 0, 'offsets': offsets,
               'status': status, 'started': started, 'finished': finished,
               'progress': progress if progress < 604801 else 0}
     return result
@@ -311,3 +684,139 @@ def aggregate_logs(data):
     """Aggregate test run logs collected from all slaves to display an aggregated debug info."""
     result = [{'host': item['host'], 'logs': item['logs']} for item in data]
     return result
+
+
+def compare_testruns(trids, threshold=REGRESSION_THRESHOLD):
+    """Line up harvested test runs per action and per step, steps are matched by their order
+    in the tests (TestRuns.test). Throughput (completed transactions per second),
+    error rate (failed and incomplete transactions, %) and latency percentiles (ms)
+    of every step are compared with the first test run, the baseline.
+    Deltas are relative (%) except for error rate (percentage points); a delta is significant
+    if Welch's t of per-second samples is above SIGNIFICANCE_T, and is a regression if it is worse
+    than the threshold, unless it is found insignificant.
+    :return: a dictionary for the comparison page and API.
+    """
+    runs = []
+    errors = []
+    for trid in trids:
+        test_run = db_queries.get_test_run(trid)
+        if test_run is None:
+            errors.append('Could not find test run #%s.' % trid)
+        elif not db_queries.harvested_slaves(test_run.title):
+            errors.append('Test run "%s" has not been harvested from slaves.' % test_run.title)
+        else:
+            runs.append((test_run, json.loads(test_run.test)))
+    result = {'runs': [{'id': test_run.id, 'title': test_run.title,
+                        'submitted': test_run.submitted, 'mode': test.get('mode', 'closed')}
+                       for test_run, test in runs],
+              'threshold': threshold, 'metrics': ['throughput', 'error_rate'] +
+              [etools.percentile_field(percentile) for percentile in etools.PERCENTILES],
+              'actions': {}, 'regressions': 0, 'errors': errors}
+    if len(runs) < 2:
+        errors.append('At least two harvested test runs are needed for a comparison.')
+        return result
+    steps = min([len(test['intervals']) for _, test in runs])
+    if any(len(test['intervals']) != steps for _, test in runs):
+        errors.append('Test runs have different number of steps, first %s are compared.' % steps)
+    modes = {test.get('mode', 'closed') for _, test in runs}
+    actions = [action for action in sorted(runs[0][1]['actions'])
+               if all(action in test['actions'] for _, test in runs)]
+    for action in actions:
+        samples = [step_metrics(test_run.id, test, action, steps) for test_run, test in runs]
+        rows = []
+        for step in range(steps):
+            loads = [sum(test['actions'][action][:step + 1]) for _, test in runs]
+            durations = [test['intervals'][step] for _, test in runs]
+            row = {'step': step + 1, 'loads': loads, 'durations': durations,
+                   'load_differs': len(set(loads)) > 1 or len(set(durations)) > 1 or len(modes) > 1,
+                   'metrics': {}}
+            for metric in result['metrics']:
+                baseline = samples[0][step].get(metric, (None, []))
+                row['metrics'][metric] = [compare_metric(metric, baseline,
+                                                         item[step].get(metric, (None, [])),
+                                                         threshold) for item in samples]
+                row['metrics'][metric][0].update({'delta': None, 'significant': None,
+                                                  'regression': False})
+                result['regressions'] += sum(item['regression'] for item in row['metrics'][metric])
+            rows.append(row)
+        result['actions'][action] = rows
+    return result
+
+
+def step_metrics(trid, test, action, steps):
+    """Metrics of an action in every step of a harvested test run:
+    {metric: (value of the step, per-second samples)}, no percentiles if nothing has completed.
+    """
+    first = int(float(db_queries.get_results_started(trid)))
+    counts = {}
+    for second, code, count in db_queries.get_results_counts(trid, action):
+        item = counts.setdefault(second - first, {'passed': 0, 'failed': 0, 'incomplete': 0})
+        item['incomplete' if code is None else 'passed' if code == 200 else 'failed'] += count
+    histograms = {}
+    for second, bucket, count in db_queries.get_results_histograms(trid, action):
+        histograms.setdefault(second - first, {})[bucket] = count
+    bounds = {second - first: (low, high)
+              for second, low, high in db_queries.get_results_bounds(trid, action)}
+    result = []
+    start = 0
+    for duration in test['intervals'][:steps]:
+        seconds = range(start, start + duration)
+        start += duration
+        items = [counts.get(second, {'passed': 0, 'failed': 0, 'incomplete': 0})
+                 for second in seconds]
+        completed = [item['passed'] + item['failed'] for item in items]
+        failed = [item['failed'] + item['incomplete'] for item in items]
+        started = [sum(item.values()) for item in items]
+        metrics = {'throughput': (sum(completed) / float(duration), completed),
+                   'error_rate': (100.0 * sum(failed) / sum(started) if sum(started) else 0.0,
+                                  [100.0 * fail / total for fail, total in zip(failed, started)
+                                   if total])}
+        merged = {}
+        for second in seconds:
+            for bucket, count in histograms.get(second, {}).items():
+                merged[bucket] = merged.get(bucket, 0) + count
+        if merged:
+            per_second = [etools.histogram_percentiles(histograms[second], etools.PERCENTILES,
+                                                       *bounds.get(second, (None, None)))
+                          for second in seconds if second in histograms]
+            step_bounds = [bounds[second] for second in seconds if second in bounds]
+            low = min([item[0] for item in step_bounds]) if step_bounds else None
+            high = max([item[1] for item in step_bounds]) if step_bounds else None
+            for percentile, value in etools.histogram_percentiles(merged, low=low,
+                                                                  high=high).items():
+                metrics[etools.percentile_field(percentile)] = \
+                    (value * 1000, [item[percentile] * 1000 for item in per_second])
+        result.append(metrics)
+    return result
+
+
+def compare_metric(metric, baseline, current, threshold):
+    """Compare a metric of a step with the baseline, both are (value, per-second samples)."""
+    (base, base_samples), (value, samples) = baseline, current
+    result = {'value': None if value is None else round(value, 3),
+              'delta': None, 'significant': None, 'regression': False}
+    if base is None or value is None:
+        return result
+    if metric == 'error_rate':
+        result['delta'] = round(value - base, 3)
+    elif base:
+        result['delta'] = round((value - base) * 100.0 / base, 3)
+    t = welch_t(base_samples, samples)
+    result['significant'] = None if t is None else abs(t) > SIGNIFICANCE_T
+    if result['delta'] is not None and result['significant'] is not False:
+        worse = -result['delta'] if metric == 'throughput' else result['delta']
+        result['regression'] = worse > threshold
+    return result
+
+
+def welch_t(first, second):
+    """Welch's t statistic of two samples, None if a sample has less than two values."""
+    if len(first) < 2 or len(second) < 2:
+        return None
+    means = [sum(sample) / float(len(sample)) for sample in [first, second]]
+    variances = [sum((value - mean) ** 2 for value in sample) / (len(sample) - 1)
+                 for sample, mean in zip([first, second], means)]
+    error = math.sqrt(variances[0] / len(first) + variances[1] / len(second))
+    if not error:
+        return 0.0 if means[0] == means[1] else math.copysign(float('inf'), means[1] - means[0])
+    return (means[1] - means[0]) / error
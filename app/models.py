@@ -2,6 +2,7 @@ import json
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import exc
+from sqlalchemy.ext.declarative import declared_attr
 from app import app
 
 
@@ -55,6 +56,124 @@ class TestStates(db.Model):
         return self.name
 
 
+class Harvests(db.Model):
+    """Results of a test run harvested from a slave once the test run is over, see Results."""
+    __tablename__ = 'harvests'
+    id = db.Column(db.Integer, primary_key=True)
+    testrun_id = db.Column(db.Integer, db.ForeignKey('testruns.id'), index=True)
+    slave = db.Column(db.String(50))
+    harvested = db.Column(db.String(30))
+    rows = db.Column(db.Integer)
+    error = db.Column(db.String(1024))  # empty if all the rows have been harvested
+
+    def __init__(self, testrun_id, slave, rows, error):
+        self.testrun_id = testrun_id
+        self.slave = slave
+        self.harvested = get_time_str()
+        self.rows = rows
+        self.error = error
+
+    def __repr__(self):
+        return '[Harvest of TestRun #%s from %s]' % (self.testrun_id, self.slave)
+
+
+class Results(object):
+    """Rows of a table of a test run database on a slave, kept in 'results_<table>' on master:
+    columns are named as in the slave table, so the readers of monitor.py work on both.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    slave = db.Column(db.String(50))
+
+    @declared_attr
+    def testrun_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('testruns.id'))
+
+    @declared_attr
+    def __table_args__(cls):
+        return db.Index('ix_%s_run' % cls.__tablename__, 'testrun_id', 'slave', *cls.key),
+
+
+class ResultsInfo(Results, db.Model):
+    __tablename__ = 'results_info'
+    key = []
+    test_run_id = db.Column(db.Text)
+    test_run_status = db.Column(db.Text)
+    slave_name = db.Column(db.Text)
+    timestamp_started = db.Column(db.Text)
+    timestamp_completed = db.Column(db.Text)
+    total_load_info = db.Column(db.Text)
+    slave_load_info = db.Column(db.Text)
+    fire_at = db.Column(db.Text)
+    start_offset = db.Column(db.Float)
+
+
+class ResultsRollup(Results, db.Model):
+    __tablename__ = 'results_rollup'
+    key = ['second', 'action']
+    second = db.Column(db.Integer)
+    action = db.Column(db.Text)
+    atomic = db.Column(db.Boolean)
+    code = db.Column(db.Integer)
+    count = db.Column(db.Integer)
+    latency_sum = db.Column(db.Float)
+    latency_min = db.Column(db.Float)
+    latency_max = db.Column(db.Float)
+    corrected_sum = db.Column(db.Float)
+    corrected_max = db.Column(db.Float)
+    wait_sum = db.Column(db.Float)
+    bytes_in = db.Column(db.Integer)
+    bytes_out = db.Column(db.Integer)
+
+
+class ResultsReasons(Results, db.Model):
+    __tablename__ = 'results_reasons'
+    key = []
+    code = db.Column(db.Integer)
+    reason = db.Column(db.Text)
+    count = db.Column(db.Integer)
+
+
+class ResultsArrivals(Results, db.Model):
+    __tablename__ = 'results_arrivals'
+    key = ['second', 'action']
+    second = db.Column(db.Integer)
+    action = db.Column(db.Text)
+    started = db.Column(db.Integer)
+    dropped = db.Column(db.Integer)
+    lag_sum = db.Column(db.Float)
+    lag_max = db.Column(db.Float)
+
+
+class ResultsHistograms(Results, db.Model):
+    __tablename__ = 'results_histograms'
+    key = ['second', 'action']
+    second = db.Column(db.Integer)
+    action = db.Column(db.Text)
+    atomic = db.Column(db.Boolean)
+    bucket = db.Column(db.Integer)
+    count = db.Column(db.Integer)
+
+
+class ResultsRecs(Results, db.Model):
+    __tablename__ = 'results_recs'
+    key = ['action']
+    atomic = db.Column(db.Boolean)
+    timestamp = db.Column(db.Text)
+    action = db.Column(db.Text)
+    user = db.Column(db.Text)
+    latency = db.Column(db.Text)
+    code = db.Column(db.Integer)
+    reason = db.Column(db.Text)
+    intended = db.Column(db.Text)
+    wait = db.Column(db.Float)
+    bytes_in = db.Column(db.Integer)
+    bytes_out = db.Column(db.Integer)
+
+
+RESULTS = {'info': ResultsInfo, 'rollup': ResultsRollup, 'reasons': ResultsReasons,
+           'arrivals': ResultsArrivals, 'histograms': ResultsHistograms, 'recs': ResultsRecs}
+
+
 @app.before_first_request
 def startup():
     db.create_all()
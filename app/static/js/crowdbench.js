@@ -1,4 +1,9 @@
 var graph_interval;
+var chart_stream = null;  // EventSource of the master, used to monitor all slaves together
+var chart;
+var chart_data = [];  // buckets received so far for the current slave, y-axis and actions
+var chart_cursor = 0;  // 'since' second to be sent with the next poll
+var chart_generation = 0;  // incremented on reset, to drop responses to outdated polls
 
 $(function() {
 
@@ -6,18 +11,14 @@ $(function() {
 
 		if ($('#chartdiv').length) {
 
-		    update_graph()
-		    graph_interval = setInterval(function() {
-		        update_graph()
-		    }, 5000); //time in milliseconds;
+		    start_updates()
 
 		    $('input[name=y_axis]:radio').change(function () {
-		        $('.amcharts-title tspan').html(this.title)
-		        update_graph()
+		        reset_graph()
 		    });
 
 		    $('input[name^=Action]').change(function () {
-		        update_graph()
+		        reset_graph()
 		    });
 
 		}
@@ -29,7 +30,12 @@ $(function() {
 
 
 function draw_chart(data, fields) {
-    colors = {"failed": "red", "passed": "green", "incomplete": "blue"}
+    colors = {"failed": "red", "passed": "green", "incomplete": "blue",
+              "started": "green", "dropped": "red", "lag_max": "orange",
+              "average": "green", "corrected": "blue", "max": "orange", "corrected_max": "red",
+              "p50": "green", "p90": "olive", "p95": "blue", "p99": "purple", "p99_9": "red",
+              "connection_wait": "red", "server_wait": "blue", "cap_wait": "orange",
+              "requests": "green", "kb_in": "blue", "kb_out": "purple"}
     graphs = []
     for (i=0; i<fields.length; i++) {
         graphs[i] = {"title": fields[i],
@@ -81,6 +87,71 @@ function draw_chart(data, fields) {
 } // function draw_chart()
 
 
+function merge_chart_data(since, items) {
+    // the response is the full state of buckets from 'since' second, so the tail is replaced
+    i = chart_data.length
+    while (i > 0 && parseInt(chart_data[i - 1]['timestamp']) >= since) i--
+    chart_data.splice(i, chart_data.length - i)
+    for (j=0; j<items.length; j++) chart_data.push(items[j])
+    if (chart_data.length > 3600) chart_data.splice(0, chart_data.length - 3600)  // last hour
+}
+
+
+function reset_graph() {
+    chart_data = []
+    chart_cursor = 0
+    chart_generation++
+    if (chart) {
+        chart.clear()
+        chart = null
+    }
+    start_updates()
+}
+
+
+function start_updates() {
+    // all slaves together: the master pushes events, a single slave: its agent is polled
+    clearInterval(graph_interval)
+    if (chart_stream) {
+        chart_stream.close()
+        chart_stream = null
+    }
+    if (document.getElementById('slave').value == 'total' && window.EventSource) {
+        open_stream()
+    } else {
+        update_graph()
+        graph_interval = setInterval(function() {
+            update_graph()
+        }, 5000); //time in milliseconds;
+    }
+}
+
+
+function open_stream() {
+    url = '/testruns/' + encodeURIComponent(document.getElementById('test_run_id').value) + '/stream'
+    url += '?y_axis=' + document.querySelector('input[name=y_axis]:checked').value
+    url += '&actions=' + get_actions_string()
+    url += '&since=' + chart_cursor
+    var generation = chart_generation, events = 0
+    chart_stream = new EventSource(url)
+    chart_stream.onmessage = function (event) {
+        if (generation != chart_generation) return  // the chart has been reset meanwhile
+        data = JSON.parse(event.data)
+        show_chart_data(data['since'], data['chart'], 'total')
+        if (data.hasOwnProperty('summary')) {
+            show_summary(data['summary'])
+        }
+        if (events++ % 5 == 0) update_debug_info()  // logs are not pushed, refresh them seldom
+    }
+    chart_stream.addEventListener('end', function () {
+        // the test run is over, do not let EventSource reconnect
+        if (chart_stream) chart_stream.close()
+        chart_stream = null
+        update_debug_info()
+    })
+}
+
+
 function zoomChart() {
     chart.zoomToIndexes(chart.dataProvider.length - 60, chart.dataProvider.length - 1);
 }
@@ -96,8 +167,12 @@ function get_actions_string() {
 
 function get_y_axis_title() {
     value = document.querySelector('input[name=y_axis]:checked').value
-    if (value == 'avgl' || value == 'avgd')
+    if (['avgl', 'avgd', 'cavl', 'cavd', 'pctl', 'pctd', 'pool'].indexOf(value) >= 0)
         return 'milliseconds'
+    if (value == 'net')
+        return 'KB/sec, requests/sec'
+    if (value == 'sched')
+        return 'arrivals/sec, lag in milliseconds'
     return 'op/sec'
 }
 
@@ -112,31 +187,46 @@ function update_graph() {
 	url += '&y_axis=' + document.querySelector('input[name=y_axis]:checked').value
 	url += '&actions=' + get_actions_string()
 	url += '&slave=' + slave
+	url += '&since=' + chart_cursor
+	var since = chart_cursor, generation = chart_generation
 	//alert(url)
 	$.ajax({url: url,
 	        type: "GET", dataType: 'JSONP', jsonpCallback: 'callback',
             headers: {"Access-Control-Allow-Origin": "*"},
     }).done(function (data) {
         console.log(data)
-        draw_chart(data[slave], ["failed", "passed", "incomplete"])
-        $('#status').html(data["status"])
-        $('#started').html(human_time(data["started"]) + ' [timestamp: ' + data["started"] + ' ]')
-		$('#finished').html(human_time(data["finished"]) + ' [timestamp: ' + data["finished"] + ' ]')
-		$('#progress').html(data["progress"])
+        if (generation != chart_generation) return  // the chart has been reset while waiting
+        show_chart_data(since, data, slave)
         update_summary()
+	});
+}
 
-        if (data["status"] != '' && data["status"] != 'IN PROGRESS') {
-            clearInterval(graph_interval);
-            states = {'FINISHED': 2, 'ABORTED': 3, 'CANCELLED': 3}
-            $.getJSON("/_test_update",
-                      {"test_run_title": document.getElementById('test_run_id').value,
-                       "completed": data["finished"], "status": states[data["status"]]},
-                      function(data) {
-                          console.log('Updated local database ' + data)
-	        });  // getJSON
-		}
 
-	});
+function show_chart_data(since, data, slave) {
+    merge_chart_data(since, data[slave])
+    chart_cursor = data["cursor"]
+    if (chart) {
+        chart.validateData()
+    } else {
+        draw_chart(chart_data, data["fields"])
+    }
+    $('#status').html(data["status"])
+    $('#started').html(human_time(data["started"]) + ' [timestamp: ' + data["started"] + ' ]')
+    $('#finished').html(human_time(data["finished"]) + ' [timestamp: ' + data["finished"] + ' ]')
+    $('#progress').html(data["progress"])
+    $('#offsets').html(describe_offsets(data["offsets"]))
+    $('#unreachable').html(describe_unreachable(data["unreachable"]))
+
+    states = {'FINISHED': 2, 'ABORTED': 3, 'CANCELLED': 3}
+    if (data["status"] in states) {  // ARMING, ARMED and IN PROGRESS mean still running
+        clearInterval(graph_interval);
+        $.getJSON("/_test_update",
+                  {"test_run_title": document.getElementById('test_run_id').value,
+                   "completed": data["finished"], "status": states[data["status"]]},
+                  function(data) {
+                      console.log('Updated local database ' + data)
+        });  // getJSON
+    }
 }
 
 
@@ -153,19 +243,24 @@ function update_summary() {
             headers: {"Access-Control-Allow-Origin": "*"},
     }).done(function (data) {
         console.log(data)
-        content = '<h5>Summary of responses</h5>'
-        content += '<table><tr><th>Count</th><th>Response Code</th><th>Response Reason</th></tr>'
-        for (i=0; i<data.length; i++) {
-            content += '<tr><td>' + data[i]['count'] + '</td>'
-            content += '<td>' + data[i]['code'] + '</td><td>' + data[i]['reason'] + '</td></tr>'
-        }
-        content +=  '</table>'
-        $('#summary').html(content)
+        show_summary(data)
         update_debug_info()
 	});
 }
 
 
+function show_summary(data) {
+    content = '<h5>Summary of responses</h5>'
+    content += '<table><tr><th>Count</th><th>Response Code</th><th>Response Reason</th></tr>'
+    for (i=0; i<data.length; i++) {
+        content += '<tr><td>' + data[i]['count'] + '</td>'
+        content += '<td>' + data[i]['code'] + '</td><td>' + data[i]['reason'] + '</td></tr>'
+    }
+    content +=  '</table>'
+    $('#summary').html(content)
+}
+
+
 function update_debug_info() {
     slave = document.getElementById('slave').value
 	url = '/_get_logs'
@@ -190,6 +285,24 @@ function update_debug_info() {
 	});
 }
 
+function describe_offsets(offsets) {
+    // how late each slave has actually started after the moment chosen by the master
+    values = []
+    for (host in offsets || {}) {
+        offset = offsets[host]
+        values.push(host + ': ' + (isNaN(parseFloat(offset)) ? offset : (offset * 1000).toFixed(1) + ' ms'))
+    }
+    return values.join(', ')
+}
+
+
+function describe_unreachable(unreachable) {
+    hosts = []
+    for (host in unreachable || {}) hosts.push(host + ' (' + unreachable[host] + ')')
+    return hosts.length ? hosts.join(', ') : 'none'
+}
+
+
 function human_time(UNIX_timestamp){
     if (isNaN(parseFloat(UNIX_timestamp))) {
         return UNIX_timestamp
@@ -1,16 +1,139 @@
 import os
+import io
 import sys
-import urllib.request
+import json
+import time
+import shlex
+import hashlib
+import html
+import tarfile
+import asyncio
 import telnetlib
 import socket
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+import aiohttp
 import paramiko
-import paramiko_expect
 from .engine import actions  # do not remove - required for collect_actions()
 
 
-def http_get(url):
-    """A simple way to open a url and return a response instance."""
-    return urllib.request.urlopen(url)
+AGENT_TIMEOUT = 3  # seconds, a deadline for each monitoring agent to respond
+AGENT_START_TIMEOUT = 10  # seconds for a (re)started monitoring agent to listen on its port
+SSH_KEEPALIVE = 30  # seconds between keepalive packets on pooled SSH connections
+SNAPSHOT_TTL = 5  # seconds a snapshot of monitoring data is shared, the poll period of the page
+SNAPSHOT_KEEP = 600  # seconds an unused snapshot is kept, chart data is updated from the last one
+
+
+class AgentsClient(object):
+    """A class to send HTTP GET requests to monitoring agents on all slaves concurrently.
+    An event loop runs in a background thread and keeps one aiohttp session,
+    so connections to agents are pooled and kept alive between requests to the master.
+    """
+    def __init__(self, timeout=AGENT_TIMEOUT, keepalive=60):
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.session = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def get(self, url):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(keepalive_timeout=self.keepalive)
+            self.session = aiohttp.ClientSession(connector=connector)
+        async with self.session.get(url) as response:
+            body = await response.read()
+            if response.status != 200:
+                return None, 'HTTP %s %s' % (response.status, response.reason)
+            return body, None
+
+    async def fetch(self, url, timeout):
+        """Return a 2-tuple (response body, error), only one of them is not None."""
+        try:
+            return await asyncio.wait_for(self.get(url), timeout)
+        except asyncio.TimeoutError:
+            return None, 'No response in %s seconds' % timeout
+        except (aiohttp.ClientError, OSError) as err:
+            return None, '%s: %s' % (type(err).__name__, err)
+
+    async def fetch_all(self, urls, timeout):
+        hosts = list(urls.keys())
+        results = await asyncio.gather(*[self.fetch(urls[host], timeout) for host in hosts])
+        return dict(zip(hosts, results))
+
+    def get_all(self, urls, timeout=None):
+        """Query all urls at once, urls is a dictionary {host: url}.
+        Total time is the time of the slowest agent, but not more than the timeout.
+        :return: a dictionary {host: (response body, error)}.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.fetch_all(urls, timeout or self.timeout),
+                                                  self.loop)
+        return future.result()
+
+
+_agents_client = None
+_agents_client_lock = Lock()
+
+
+def agents_client():
+    """Return the AgentsClient instance shared by all requests to the master, create on demand."""
+    global _agents_client
+    with _agents_client_lock:
+        if _agents_client is None:
+            _agents_client = AgentsClient()
+    return _agents_client
+
+
+class SnapshotCache(object):
+    """A class to share monitoring data collected from slaves between all viewers of a test run.
+    A snapshot is fresh for ttl seconds (a caller may ask for a shorter one); while one request
+    collects a snapshot, concurrent requests for the same key wait for it instead of polling
+    slaves again. The last snapshot of a key is kept for SNAPSHOT_KEEP seconds, see last().
+    """
+    def __init__(self, ttl=SNAPSHOT_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.snapshots = {}  # key: (collection time, snapshot)
+        self.in_flight = {}  # key: Event set once the snapshot is collected
+
+    def get(self, key, func, *args, ttl=None):
+        """Return a snapshot for the key not older than ttl seconds,
+        call func(*args) to collect it if there is none.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                snapshot = self.snapshots.get(key)
+                if snapshot and now - snapshot[0] < ttl:
+                    return snapshot[1]
+                event = self.in_flight.get(key)
+                leader = event is None
+                if leader:
+                    event = self.in_flight[key] = Event()
+            if leader:
+                break
+            event.wait()  # then the snapshot is cached, or it has failed and is collected again
+        try:
+            result = func(*args)
+            with self.lock:
+                self.snapshots = {item: value for item, value in self.snapshots.items()
+                                  if now - value[0] < SNAPSHOT_KEEP}
+                self.snapshots[key] = (time.monotonic(), result)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+        return result
+
+    def last(self, key):
+        """The last snapshot of the key however old it is, None if there is none."""
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+        return snapshot[1] if snapshot else None
+
+
+snapshot_cache = SnapshotCache()
 
 
 def collect_actions():
@@ -46,45 +169,254 @@ def ssh_connect_errors(ssh, cnf, timeout=3):
     return errors
 
 
+class SSHPool(object):
+    """A class to keep long-lived authenticated SSH connections to slaves, one per slave.
+    A connection is checked before it is handed out and re-established if it is broken,
+    an SFTP channel is opened once per connection and reused.
+    """
+    def __init__(self, timeout=3, keepalive=SSH_KEEPALIVE):
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.clients = {}  # slave key -> paramiko.SSHClient
+        self.sftps = {}    # slave key -> paramiko.SFTPClient
+        self.locks = {}    # slave key -> Lock, to connect to the same slave once
+        self.lock = Lock()
+
+    @staticmethod
+    def key(cnf):
+        return cnf['host'], cnf['ssh_port'], cnf['username'], cnf['password']
+
+    def host_lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, Lock())
+
+    @staticmethod
+    def is_alive(ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    def connect(self, cnf):
+        """Return a 2-tuple (SSH client, errors), the client is None if connection failed."""
+        key = self.key(cnf)
+        with self.host_lock(key):
+            ssh = self.clients.get(key)
+            if ssh is not None and self.is_alive(ssh):
+                return ssh, []
+            self.close(key)
+            ssh = paramiko.SSHClient()
+            errors = ssh_connect_errors(ssh, cnf, self.timeout)
+            if errors:
+                ssh.close()
+                return None, errors
+            ssh.get_transport().set_keepalive(self.keepalive)
+            self.clients[key] = ssh
+            return ssh, []
+
+    def sftp(self, cnf):
+        """Return an SFTP client on the pooled connection to a slave, open it on first use."""
+        ssh, errors = self.connect(cnf)
+        if errors:
+            return None, errors
+        key = self.key(cnf)
+        with self.host_lock(key):
+            sftp = self.sftps.get(key)
+            if sftp is None or sftp.get_channel().closed:
+                sftp = self.sftps[key] = ssh.open_sftp()
+        return sftp, []
+
+    def close(self, key):
+        """Close a connection (and its SFTP channel) and forget about it, the caller holds a lock."""
+        sftp = self.sftps.pop(key, None)
+        ssh = self.clients.pop(key, None)
+        for item in [sftp, ssh]:
+            if item is not None:
+                try:
+                    item.close()
+                except (paramiko.SSHException, socket.error, EOFError):
+                    pass
+
+    def discard(self, cnf):
+        """Drop a connection which failed during use, it will be re-established on next use."""
+        key = self.key(cnf)
+        with self.host_lock(key):
+            self.close(key)
+
+    @contextmanager
+    def session(self, cnf):
+        """Yield a 2-tuple (SSH client, errors), drop the connection if it fails during use."""
+        ssh, errors = self.connect(cnf)
+        try:
+            yield ssh, errors
+        except (paramiko.SSHException, socket.error, EOFError):
+            self.discard(cnf)
+            raise
+
+
+ssh_pool = SSHPool()  # shared by all requests to the master
+
+
 def ssh_runcmd(ssh, cmd):
     """Execute any command on a remote host through SSH."""
     return ssh.exec_command(cmd, get_pty=True)
 
 
-def ssh_transfer(ssh, cnf, files):
-    """A function to read content of files stored locally and write same files on a remote host."""
+def ssh_transfer(sftp, cnf, files):
+    """A function to copy files stored locally onto a remote host through an SFTP channel."""
     errors = []
-    sftp = ssh.open_sftp()
     for fname in files:
-        if os.path.isfile(fname):
-            with open(fname, 'r+') as _f:
-                content = _f.read()
-        else:
+        if not os.path.isfile(fname):
             errors.append('Could not find file "%s" to copy onto slave %s.' % (fname, cnf['host']))
             continue
         remote_path = '%s/%s' % (cnf['folder'], fname.split(os.sep)[-1])
         try:
-            with sftp.open(remote_path, 'w+') as remote_f:
-                remote_f.write(content)
+            sftp.put(fname, remote_path, confirm=False)
         except IOError as err:
             errors.append('Error accessing file %s on %s: %s' % (remote_path, cnf['host'], err))
     return errors
 
 
-def ssh_interact(ssh, cnf, cmd, expect_msg='$'):
-    """A function to start a command on remote host through SSH, without waiting until it ends,
-    exit when expect_msg is displayed.
+def read_bundle(files):
+    """Read files to deploy onto slaves once for all of them.
+    :return: a 2-tuple ({file name: (content, SHA-256 of the content)}, errors).
     """
+    bundle = {}
     errors = []
-    with paramiko_expect.SSHClientInteraction(ssh, timeout=5, display=False) as sshi:
-        sshi.send(cmd)
+    for fname in files:
+        if not os.path.isfile(fname):
+            errors.append('Could not find file "%s" to copy onto slaves.' % fname)
+            continue
+        with open(fname, 'rb') as _f:
+            content = _f.read()
+        bundle[os.path.basename(fname)] = (content, hashlib.sha256(content).hexdigest())
+    return bundle, errors
+
+
+def pack_bundle(contents):
+    """Pack files {file name: content} into a gzip-compressed tar archive in memory."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, content in sorted(contents.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = time.time()
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def ssh_python(ssh, cnf, script, args):
+    """Run a python one-liner in the slave folder through SSH and wait until it ends.
+    :return: a 2-tuple (output, errors).
+    """
+    cmd = 'cd %s && %s -c %s %s' % (cnf['folder'], cnf['python3'], shlex.quote(script),
+                                    ' '.join(shlex.quote(arg) for arg in args))
+    _, out, err = ssh.exec_command(cmd)
+    output = out.read().decode('utf-8')
+    if out.channel.recv_exit_status():
+        return output, ['Command failed on slave %s: %s' % (cnf['host'],
+                                                            err.read().decode('utf-8').strip())]
+    return output, []
+
+
+def ssh_deploy_bundle(ssh, sftp, cnf, bundle):
+    """Deploy files onto a slave incrementally: the slave tells SHA-256 of the files it has,
+    files which differ are sent in one compressed archive unpacked in the slave folder.
+    :return: a 2-tuple (names of files sent, errors).
+    """
+    script = 'import hashlib, json, os, sys; print(json.dumps({name: hashlib.sha256(' \
+             'open(name, "rb").read()).hexdigest() for name in sys.argv[1:] if os.path.isfile(name)}))'
+    output, errors = ssh_python(ssh, cnf, script, sorted(bundle))
+    if errors:
+        return [], errors
+    try:
+        hashes = json.loads(output)
+    except ValueError:
+        return [], ['Could not get hashes of files from slave %s: %s' % (cnf['host'], output)]
+    changed = {name: content for name, (content, digest) in bundle.items()
+               if hashes.get(name) != digest}
+    if not changed:
+        return [], []
+    remote_path = '%s/bundle.tar.gz' % cnf['folder']
+    try:
+        sftp.putfo(io.BytesIO(pack_bundle(changed)), remote_path, confirm=False)
+    except IOError as err:
+        return [], ['Error writing file %s on %s: %s' % (remote_path, cnf['host'], err)]
+    script = 'import os, tarfile; tarfile.open("bundle.tar.gz").extractall(); ' \
+             'os.remove("bundle.tar.gz")'
+    return sorted(changed), ssh_python(ssh, cnf, script, [])[1]
+
+
+def ssh_write(sftp, cnf, fname, content):
+    """Write a small file in the slave folder atomically: a temporary file is renamed at the end."""
+    remote_path = '%s/%s' % (cnf['folder'], fname)
+    try:
+        with sftp.open(remote_path + '.tmp', 'w') as remote_f:
+            remote_f.write(content)
+        sftp.posix_rename(remote_path + '.tmp', remote_path)
+    except IOError as err:
+        return ['Error writing file %s on %s: %s' % (remote_path, cnf['host'], err)]
+    return []
+
+
+def ssh_wait_file(sftp, cnf, fname, timeout, period=0.1):
+    """Wait until a file appears in the slave folder."""
+    remote_path = '%s/%s' % (cnf['folder'], fname)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
         try:
-            sshi.expect(expect_msg, timeout=1)
-        except socket.timeout:
-            output = sshi.current_output.strip()
-            if 'Traceback' in output or 'Cannot start' in output:
-                errors = ['Command "%s" failed on slave %s. %s' % (cmd, cnf['host'], output)]
-    return errors
+            sftp.stat(remote_path)
+            return []
+        except IOError:
+            time.sleep(period)
+    return ['No %s on %s after %s seconds.' % (remote_path, cnf['host'], timeout)]
+
+
+def ssh_launch(ssh, cnf, cmd, log_fname):
+    """A function to start a command in background in the slave folder through SSH,
+    without waiting until it ends: the shell exits as soon as the command is started.
+    """
+    cmd = 'cd %s && (nohup %s %s < /dev/null > %s 2>&1 &)' % \
+          (cnf['folder'], cnf['python3'], cmd, log_fname)
+    _, out, err = ssh.exec_command(cmd)
+    if out.channel.recv_exit_status():
+        output = (out.read() + err.read()).decode('utf-8').strip()
+        return ['Command "%s" failed on slave %s. %s' % (cmd, cnf['host'], output)]
+    return []
+
+
+def ssh_wait_agent(ssh, cnf, log_fname, timeout=AGENT_START_TIMEOUT, period=0.5):
+    """Wait until a monitoring agent started by ssh_launch() is up: the launch succeeds even if
+    the agent fails at once. The agent is up once its port has been open on two checks in a row
+    and its log tells of no failure (the port may be taken by another process: the agent fails).
+    """
+    deadline = time.time() + timeout
+    listening = False
+    while time.time() < deadline:
+        tail = ssh_log_tail(ssh, cnf, log_fname)
+        if 'Traceback' in tail or 'Cannot start' in tail:
+            return ['Monitoring agent on %s has failed to start. %s' % (cnf['host'], tail)]
+        if check_connectivity(cnf['host'], cnf['web_port'], 1):
+            if listening:
+                return []
+            listening = True
+        time.sleep(period)
+    return ['Monitoring agent on %s is not listening on port %s after %s seconds. %s'
+            % (cnf['host'], cnf['web_port'], timeout, ssh_log_tail(ssh, cnf, log_fname))]
+
+
+def ssh_log_tail(ssh, cnf, log_fname, lines=10):
+    """The last lines of a log in the slave folder, to explain a failure of a launched command."""
+    _, out, _ = ssh.exec_command('tail -n %s %s' % (lines, shlex.quote('%s/%s' % (cnf['folder'],
+                                                                               log_fname))))
+    output = out.read().decode('utf-8', 'replace').strip()
+    return 'Last lines of %s:<br>%s' % (log_fname, html.escape(output).replace('\n', '<br>')) \
+        if output else ''
 
 
 def collect_threads_results(queue):
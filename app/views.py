@@ -1,6 +1,7 @@
 import os
 import json
-from flask import render_template, redirect, url_for, request, jsonify, flash
+from flask import render_template, redirect, url_for, request, jsonify, flash, \
+    Response, stream_with_context
 from app import app
 from . import helpers, db_queries, tools as atools
 from .forms import ConfigForm, TestRunForm, TestViewForm
@@ -20,9 +21,11 @@ def get_test_run_info():
 @app.route('/_test_update')
 def update_test_run_on_end():
     """For AJAX requests, when test is finished,
-    update test run metadata in a local database on master node (if not updated before).
+    update test run metadata in a local database on master node (if not updated before)
+    and harvest its results from slaves (if not harvested yet), see helpers.harvest_testrun().
     """
     test_run_title = request.args.get('test_run_title')
+    helpers.harvest_later(test_run_title)
     test_run = db_queries.get_test_run_by_title(test_run_title)
     if test_run.completed:  # No update needed, it was updated earlier
         result = {'test_run_title': test_run_title, 'message': 'Updated earlier. Nothing to do.'}
@@ -35,15 +38,40 @@ def update_test_run_on_end():
     return jsonify(result)
 
 
+@app.route('/_compare_testruns')
+def compare_test_runs_data():
+    """For API requests, compare test runs 'ids' (the first one is the baseline) per action and step,
+    see helpers.compare_testruns().
+    """
+    return jsonify(helpers.compare_testruns(request.args.getlist('ids', type=int),
+                                            request.args.get('threshold', helpers.REGRESSION_THRESHOLD,
+                                                             type=float)))
+
+
 @app.route('/_get_chartdata')
 @app.route('/_get_summary')
 @app.route('/_get_logs')
 def get_aggregated_data():
-    """For AJAX requests, used to collect and aggregate data from all slaves."""
-    result = helpers.monitor_slaves(request.url)
+    """For AJAX requests, used to collect and aggregate data from all slaves.
+    Viewers asking for the same data share one snapshot whatever their 'since' cursors of chart data
+    are, see helpers.monitor_snapshot().
+    """
+    result = helpers.monitor_snapshot(request.path, request.args.to_dict())
     return '{0}({1})'.format(request.args.get('callback'), result)
 
 
+@app.route('/testruns/<test_run_id>/stream')
+def stream_testrun(test_run_id):
+    """Server-Sent Events for the monitoring page: chart buckets, summary, status and progress
+    of the test run are pushed every second instead of being polled, see helpers.stream_testrun().
+    """
+    events = helpers.stream_testrun(test_run_id, request.args.get('y_axis', 'aops'),
+                                    request.args.get('actions', ''),
+                                    request.args.get('since', 0, type=int))
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/monitor')
 def monitor():
     """Monitoring page of a particular test run."""
@@ -60,7 +88,7 @@ def monitor():
 def new_testrun():
     """Construct a test run, if load is valid, a test run will be started on all slaves in parallel.
     Metadata of a test run will be inserted into a local database on master node.
-    TODO: slaves start not simultaneously - second slave starts ~3 sec after the first one.
+    Slaves are armed first and then fired to start at the same moment, see helpers.start_slaves().
     """
     form = TestRunForm(request.form)
     text = ''
@@ -79,6 +107,7 @@ def new_testrun():
                 msg, style, test_run = db_queries.create_test_run(obj.test_run_id, text, load_str)
                 flash(msg, style)
                 if not errors:
+                    helpers.harvest_later(obj.test_run_id, obj.duration)
                     return redirect(url_for('monitor', test_run_id=obj.test_run_id))
             for error in errors:
                 flash(error, 'danger')
@@ -89,8 +118,10 @@ def new_testrun():
 def install():
     """(Re)deploy all slave nodes from a web-page:
     - if slaves settings are valid, conf.yaml is (re)written;
-    - all files from engine folder except master.py and __init__.py are written onto slaves;
-    - monitoring agents are (re)started on slaves.
+    - all files from engine folder (code and data files) are written onto slaves,
+      users.txt is indexed instead, a slave gets the slice of users it needs with a test run;
+    - monitoring agents are (re)started on slaves;
+    - slaves marked to be calibrated measure requests per second they can generate.
     TODO: improve parsing output of SSH commands executed to handle slaves' errors better.
     """
     if request.method == 'GET':
@@ -110,16 +141,23 @@ def install():
                 if msg:
                     flash(msg, 'info')
                     folder = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'engine')
+                    etools.build_user_index()  # slaves get slices of it with test runs
                     files = ['%s' % os.path.join(folder, item)
                              for item in os.listdir(folder)
-                             if item[item.rfind('.'):] in ['.py', '.txt']]
-                    errors = helpers.deploy_slaves(files)
+                             if item[item.rfind('.'):] in ['.py', '.txt', '.csv', '.jsonl'] and
+                             item != 'users.txt']
+                    messages, errors = helpers.deploy_slaves(files)
+                    if messages:
+                        flash('Files sent: %s.' % '; '.join(messages), 'info')
                     if not errors:
                         flash('All files have been deployed onto all slaves, ' +
                               'all monitoring agents are running.', 'success')
-                    else:
-                        for error in errors:
-                            flash(error, 'danger')
+                        messages, errors = helpers.calibrate_slaves(
+                            [item['host'] for item in form.hosts.data if item['calibrate']])
+                        if messages:
+                            flash('Calibrated: %s.' % '; '.join(messages), 'info')
+                    for error in errors:
+                        flash(error, 'danger')
         else:
             flash('Settings have not been processed due to form validation failure.', 'warning')
     return render_template('conf.html', form=form)
@@ -143,12 +181,30 @@ def view_test_run(trid):
     fields = [TestRuns.id, TestRuns.title, TestRuns.description,
               TestRuns.submitted, TestRuns.completed, TestStates.name, TestRuns.comment]
     test_run = db_queries.get_test_run_fields(fields, trid)
-    return render_template('testrun.html', testrun=test_run, testrun_status=test_run.name)
+    return render_template('testrun.html', testrun=test_run, testrun_status=test_run.name,
+                           harvests=db_queries.get_harvests(trid))
+
+
+@app.route('/testruns/compare', methods=['GET'])
+def compare_test_runs():
+    """Compare test runs selected in the list, regressions against the oldest one are highlighted."""
+    ids = sorted(request.args.getlist('ids', type=int))
+    comparison = helpers.compare_testruns(ids, request.args.get('threshold',
+                                                                helpers.REGRESSION_THRESHOLD,
+                                                                type=float))
+    for error in comparison['errors']:
+        flash(error, 'warning')
+    if comparison['actions']:
+        flash('Found %s regressions.' % comparison['regressions'],
+              'danger' if comparison['regressions'] else 'success')
+    return render_template('compare.html', comparison=comparison, ids=ids)
 
 
 @app.route('/testruns/delete/', methods=['POST'])
 def delete_test_run():
-    """Delete test run by id from a local database on master, remove db-,json-files from slaves."""
+    """Delete test run by id (with harvested results) from a local database on master,
+    remove db-,json-files from slaves.
+    """
     if request.form and 'item' in request.form:
         trid = int(request.form.get('item', type=int))
         test_run_title = db_queries.remove_test_run(trid)
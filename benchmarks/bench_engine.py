@@ -0,0 +1,241 @@
+"""Self-benchmark of the load engine on one Linux host with no network: a stub target
+(app/engine/stub.py) is requested by the engine doing sample actions (sample_actions.py).
+Usage: python benchmarks/bench_engine.py [--seconds 10] [--latency 0] [--size 1024] [--output FILE]
+- throughput: a real slave (slave.py) runs the closed model, requests per second per CPU core
+  are requests divided by CPU seconds of the slave and its processes;
+- recorder: cost of the recorder per request in one process, on the event loop and in the writer;
+- scheduler: the open model at a constant rate, planned vs started iterations and scheduler lag;
+- memory: RSS per virtual user while all users wait for slow responses.
+Results are written as JSON together with the commit and the host, to compare versions.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from pathos.helpers import mp
+
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ENGINE = os.path.join(BENCH, '..', 'app', 'engine')
+RESULTS_VERSION = 1      # version of the results format
+MEMORY_LATENCY = 2.0     # seconds of stub latency while memory is measured, users are parked
+ARM_TIMEOUT = 60         # seconds for the slave to get armed
+
+
+def make_workspace():
+    """A copy of the engine with sample actions: databases and files of the benchmark
+    stay out of the tree, engine modules are imported from the copy.
+    """
+    folder = tempfile.mkdtemp(prefix='crowdbench-')
+    for fname in glob.glob(os.path.join(ENGINE, '*.py')):
+        if os.path.basename(fname) != 'actions.py':
+            shutil.copy(fname, folder)
+    shutil.copy(os.path.join(BENCH, 'sample_actions.py'), os.path.join(folder, 'actions.py'))
+    sys.path.insert(0, folder)
+    return folder
+
+
+def start_stubs(count, latency, size):
+    """Stub processes sharing a port, the target should not be the bottleneck."""
+    import stub
+    port = stub.free_port()
+    stubs = [mp.Process(target=stub.run, args=(port, latency, size, '127.0.0.1', True), daemon=True)
+             for _ in range(count)]
+    for proc in stubs:
+        proc.start()
+    if not stub.wait_listening(port):
+        raise RuntimeError('Stub target has not started on port %s' % port)
+    return port, stubs
+
+
+def stop_stubs(stubs):
+    for proc in stubs:
+        proc.terminate()
+        proc.join()
+
+
+def prepare(test_run_id, users):
+    """Users and the database of a test run, as the master and the slave make them."""
+    import tools
+    tools.write_user_index(['bench-%s' % i for i in range(users)], 'users-%s.idx' % test_run_id)
+    tools.db_init(tools.get_db_conn('%s.db' % test_run_id))
+
+
+def rss_kb():
+    with open('/proc/self/status') as _f:
+        for line in _f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def in_child(func, *args):
+    """Run a scenario in a fresh process: its memory, event loop and recorder are its own."""
+    queue = mp.Queue()
+    proc = mp.Process(target=lambda: queue.put(func(*args)))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def throughput(workspace, seconds, users, workers):
+    """A real slave runs the closed model: armed and fired through files, as by the master."""
+    import tools
+    test_run_id = 'throughput'
+    prepare(test_run_id, users)
+    load = {'bench': {'actions': {'BenchGet': [users]}, 'intervals': [seconds], 'mode': 'closed',
+                      'users': {'BenchGet': [0, users]}, 'ramps': ['step'], 'workers': workers,
+                      'client': {}}}
+    with open(os.path.join(workspace, 'load.json'), 'w') as _f:
+        _f.write(json.dumps(load))
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(os.path.join(workspace, 'slave.log'), 'w') as log:
+        proc = subprocess.Popen([sys.executable, 'slave.py', '-n', 'bench', '-t', test_run_id,
+                                 '-f', os.path.join(workspace, 'load.json')],
+                                cwd=workspace, stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.time() + ARM_TIMEOUT
+        while not os.path.isfile(os.path.join(workspace, '%s.armed' % test_run_id)):
+            if time.time() > deadline or proc.poll() is not None:
+                proc.kill()
+                raise RuntimeError('The slave has not been armed, see %s/slave.log' % workspace)
+            time.sleep(0.05)
+        fname = os.path.join(workspace, '%s.fire' % test_run_id)
+        with open(fname + '.tmp', 'w') as _f:
+            _f.write(str(tools.get_timestamp() + 0.5))
+        os.replace(fname + '.tmp', fname)
+        proc.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    conn = tools.get_db_conn('%s.db' % test_run_id)
+    requests, errors = conn.execute('SELECT SUM(count), SUM(CASE WHEN code = 200 THEN 0 '
+                                    'ELSE count END) FROM rollup WHERE atomic = 1').fetchone()
+    requests = requests or 0
+    return {'requests': requests, 'errors': errors or 0, 'processes': max(1, min(workers, users)),
+            'rps': round(requests / seconds, 1), 'cpu_seconds': round(cpu, 3),
+            'rps_per_core': round(requests / cpu, 1) if cpu else 0}
+
+
+def recorder(seconds, users):
+    """Users of one process do not wait between iterations, the recorder keeps up with them."""
+    from aload import CrowdLoad
+    test_run_id = 'recorder'
+    prepare(test_run_id, users)
+    crowd = CrowdLoad('bench', test_run_id, {'users': {'BenchGet': [0, users]}}, 'BenchGet')
+    crowd.arm()
+    began = time.perf_counter()
+    crowd.schedule_users('BenchGet', [users], [seconds], ['step'])
+    elapsed = time.perf_counter() - began
+    overhead = crowd.recorder.overhead()
+    return {'records': overhead['records'],
+            'records_per_second': round(overhead['records'] / elapsed, 1),
+            'loop_us': round(overhead['loop_us'], 3), 'writer_us': round(overhead['writer_us'], 3),
+            'flushes': overhead['flushes']}
+
+
+def scheduler(seconds, rate):
+    """The open model at a constant rate: iterations planned, started and dropped, lag of starts."""
+    import tools
+    import planner
+    from aload import CrowdLoad
+    test_run_id = 'scheduler'
+    users = rate
+    prepare(test_run_id, users)
+    crowd = CrowdLoad('bench', test_run_id, {'users': {'BenchGet': [0, users]}}, 'BenchGet')
+    crowd.arm()
+    crowd.schedule_arrivals('BenchGet', [rate], [seconds])
+    planned = planner.plan_summary([rate], [seconds])[1]
+    conn = tools.get_db_conn('%s.db' % test_run_id)
+    started, dropped, lag_sum, lag_max = conn.execute(
+        'SELECT SUM(started), SUM(dropped), SUM(lag_sum), MAX(lag_max) FROM arrivals').fetchone()
+    started, dropped = started or 0, dropped or 0
+    return {'rate': rate, 'planned': planned, 'started': started, 'dropped': dropped,
+            'rate_error_pct': round(100.0 * (started - planned) / planned, 3) if planned else 0,
+            'lag_mean_ms': round(1000.0 * (lag_sum or 0) / ((started + dropped) or 1), 3),
+            'lag_max_ms': round(1000.0 * (lag_max or 0), 3)}
+
+
+def memory(users):
+    """RSS of one process before users are added and once all of them wait for responses."""
+    import asyncio
+    from aload import CrowdLoad
+    test_run_id = 'memory'
+    prepare(test_run_id, users)
+    seconds = int(MEMORY_LATENCY) + 2
+    crowd = CrowdLoad('bench', test_run_id, {'users': {'BenchGet': [0, users]}}, 'BenchGet')
+    crowd.arm()
+    base = rss_kb()
+    peak = [base]
+
+    async def sample():
+        for _ in range(seconds * 10):
+            await asyncio.sleep(0.1)
+            peak.append(rss_kb())
+
+    crowd.loop.run_until_complete(asyncio.gather(
+        crowd.pool('BenchGet', [users], [seconds], ['step']), sample()))
+    crowd.recorder.close()
+    crowd.loop.run_until_complete(crowd.close_session())
+    return {'users': users, 'rss_base_kb': base, 'rss_peak_kb': max(peak),
+            'kb_per_user': round((max(peak) - base) / float(users), 2)}
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCH,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of CrowdBench engine against a local stub.')
+    parser.add_argument('--seconds', type=int, default=10, help='duration of each scenario.')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of stub latency.')
+    parser.add_argument('--size', type=int, default=1024, help='bytes in stub responses.')
+    parser.add_argument('--users', type=int, default=100, help='users of throughput scenarios.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='slave processes, 0 - a half of CPU cores, the stub gets the rest.')
+    parser.add_argument('--rate', type=int, default=200, help='iterations per second of the open model.')
+    parser.add_argument('--memory-users', type=int, default=2000, help='users of the memory scenario.')
+    parser.add_argument('--output', default='bench-engine-%s.json' % time.strftime('%Y%m%d-%H%M%S'),
+                        help='a file to write JSON results into.')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    workers = args.workers or max(1, cores // 2)
+    workspace = make_workspace()
+    port, stubs = start_stubs(max(1, cores - workers), args.latency, args.size)
+    os.environ['CROWDBENCH_STUB'] = 'http://127.0.0.1:%s' % port
+    results = {}
+    try:
+        results['throughput'] = throughput(workspace, args.seconds, args.users, workers)
+        results['recorder'] = in_child(recorder, args.seconds, args.users)
+        results['scheduler'] = in_child(scheduler, args.seconds, args.rate)
+        stop_stubs(stubs)
+        port, stubs = start_stubs(1, MEMORY_LATENCY, args.size)
+        os.environ['CROWDBENCH_STUB'] = 'http://127.0.0.1:%s' % port
+        results['memory'] = in_child(memory, args.memory_users)
+    finally:
+        stop_stubs(stubs)
+        shutil.rmtree(workspace, ignore_errors=True)
+    report = {'version': RESULTS_VERSION, 'commit': git_version(), 'timestamp': int(time.time()),
+              'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'cores': cores},
+              'settings': dict(vars(args), workers=workers), 'results': results}
+    with open(args.output, 'w') as _f:
+        _f.write(json.dumps(report, indent=4, sort_keys=True))
+    for scenario, metrics in sorted(results.items()):
+        print('%-11s %s' % (scenario, ', '.join('%s=%s' % item for item in sorted(metrics.items()))))
+    print('Results: %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
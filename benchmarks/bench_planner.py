@@ -0,0 +1,65 @@
+"""Benchmark of the load planner on generated soak ramps with thousands of steps.
+Usage: python benchmarks/bench_planner.py [--steps 1000 2000 4000 8000] [--repeat 5]
+Time of a fresh plan should grow linearly with the duration,
+a cached plan costs only hashing of the steps.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'engine'))
+import planner  # noqa: E402
+
+
+def soak_ramp(steps, seed=0):
+    """A soak profile: a ramp up, a long plateau of small waves, a ramp down;
+    steps are 1 to 30 seconds long and alternate linear and step ramps.
+    """
+    rnd = random.Random(seed)
+    deltas, intervals, ramps = [], [], []
+    count = 0
+    for num in range(steps):
+        if num < steps // 10:
+            delta = rnd.randint(1, 20)
+        elif num >= steps - steps // 10:
+            delta = -min(count, rnd.randint(1, 40))
+        else:
+            delta = max(-count, rnd.randint(-5, 5))
+        count += delta
+        deltas.append(delta)
+        intervals.append(rnd.randint(1, 30))
+        ramps.append('linear' if num % 2 else 'step')
+    return deltas, intervals, ramps
+
+
+def measure(steps, repeat):
+    deltas, intervals, ramps = soak_ramp(steps)
+    fresh = []
+    for _ in range(repeat):
+        planner._users_per_second.cache_clear()
+        began = time.perf_counter()
+        planner.users_per_second(deltas, intervals, ramps)
+        fresh.append(time.perf_counter() - began)
+    began = time.perf_counter()
+    for _ in range(repeat):
+        planner.users_per_second(deltas, intervals, ramps)
+    cached = (time.perf_counter() - began) / repeat
+    return sum(intervals), min(fresh), cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the load planner.')
+    parser.add_argument('--steps', type=int, nargs='+', default=[1000, 2000, 4000, 8000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print('%8s %10s %12s %14s %12s' % ('steps', 'seconds', 'fresh, ms', 'ns per second', 'cached, us'))
+    for steps in args.steps:
+        seconds, fresh, cached = measure(steps, args.repeat)
+        print('%8s %10s %12.2f %14.1f %12.2f' % (steps, seconds, fresh * 1e3,
+                                                  fresh * 1e9 / seconds, cached * 1e6))
+
+
+if __name__ == '__main__':
+    main()
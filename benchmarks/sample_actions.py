@@ -0,0 +1,30 @@
+"""Sample actions of the engine benchmark, copied as actions.py into its workspace.
+The stub target is given by CROWDBENCH_STUB environment variable, see bench_engine.py.
+"""
+import os
+from action import Action
+from tools import log_sql
+
+
+STUB = os.environ.get('CROWDBENCH_STUB', 'http://127.0.0.1:18000')
+
+
+class BenchGet(Action):
+    """One GET per iteration, the body is read and discarded."""
+    body_mode = 'discard'
+
+    @log_sql
+    async def act(self):
+        code, reason, _ = await self.atomic_get('%s/get' % STUB)
+        return code, reason
+
+
+class BenchPost(Action):
+    """A POST of 1 KB and a GET per iteration, bodies are read in full."""
+    @log_sql
+    async def act(self):
+        code, reason, _ = await self.atomic_post('%s/post' % STUB, data=b'x' * 1024)
+        if code != 200:
+            return code, reason
+        code, reason, _ = await self.atomic_get('%s/get?user=%s' % (STUB, self.user))
+        return code, reason